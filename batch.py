@@ -0,0 +1,86 @@
+import csv
+import itertools
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator, Union
+
+from collect_data import CollectedData
+
+
+def check_coordinates(lat: float, lon: float) -> tuple[float, float]:
+    """
+    Validates the value range of a lat/lon pair, same rules as the interactive mode
+    """
+    if lat < -90 or lat > 90:
+        raise ValueError(f"Latitude ranges from -90 to 90 (got {lat})")
+    if lon < -180 or lon > 180:
+        raise ValueError(f"Longitude ranges from -180 to 180 (got {lon})")
+    return lat, lon
+
+
+def read_coordinates(filepath: str) -> list[tuple[float, float]]:
+    """
+    Reads a CSV file containing one site per row (lat, lon)
+    A header row and empty lines are skipped
+    """
+    coordinates = []
+    with open(filepath, newline="", encoding="utf8") as f:
+        for i, row in enumerate(csv.reader(f)):
+            if not row or not "".join(row).strip():
+                continue
+            try:
+                lat, lon = float(row[0]), float(row[1])
+            except (ValueError, IndexError):
+                if i == 0:
+                    continue  # header row
+                raise ValueError(f"Invalid row {i+1} in {filepath}: {row}")
+            coordinates.append(check_coordinates(lat, lon))
+
+    logging.info(f"Read {len(coordinates)} sites from {filepath}")
+    return coordinates
+
+
+def parse_coordinates(pairs: Iterable[str]) -> list[tuple[float, float]]:
+    """
+    Parses "lat,lon" strings typed on the command line
+    """
+    coordinates = []
+    for pair in pairs:
+        lat, lon = pair.split(",")
+        coordinates.append(check_coordinates(float(lat), float(lon)))
+    return coordinates
+
+
+def collect_many(
+    coordinates: Iterable[tuple[float, float]],
+    max_workers: int,
+    max_pending: int = None,
+    **kwargs,
+) -> Iterator[tuple[float, float, Union[CollectedData, Exception]]]:
+    """
+    Runs the data collection of many sites at once with a bounded pool of threads
+    Collection is I/O bound (GEE round-trips, downloads, weather call), so threads are enough
+    Yields (lat, lon, CollectedData) as soon as a site is done, or the exception it raised
+    Sites are submitted lazily: at most max_pending of them (2 * max_workers by default) are being
+    collected or waiting to be consumed, so memory stays bounded when the consumer is slower
+    """
+    max_pending = max_pending or 2 * max_workers
+    coordinates = iter(coordinates)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+
+        def submit_sites() -> None:
+            for lat, lon in itertools.islice(coordinates, max_pending - len(futures)):
+                futures[executor.submit(CollectedData, lat=lat, lon=lon, **kwargs)] = (lat, lon)
+
+        submit_sites()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                lat, lon = futures.pop(future)
+                try:
+                    yield lat, lon, future.result()
+                except Exception as e:
+                    logging.error(f"Data collection failed for lat={lat} and lon={lon}: {e!r}")
+                    yield lat, lon, e
+                submit_sites()
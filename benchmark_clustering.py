@@ -0,0 +1,121 @@
+"""
+Compares the color analyses (clustering backend, pixels or color histogram mode) with today's
+reference: sklearn's KMeans on the pixels of the 200x200 downscaled image
+Scenes are synthetic 1000x1000 images, the histogram mode uses them at full resolution
+
+python benchmark_clustering.py [nb_scenes]
+"""
+import itertools
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from clustering import BACKENDS, ClusteringBackend, SklearnBackend, WarmStart
+from image_analysis import color_histogram
+
+
+def synthetic_scene(rng: np.random.Generator, size: int = 1000) -> np.ndarray:
+    """
+    Patches of a few land cover colors with sensor noise, slightly blurred
+    """
+    palette = rng.integers(20, 200, (rng.integers(3, 7), 3))
+    patches = rng.integers(0, len(palette), (size // 100, size // 100))
+    scene = palette[cv2.resize(patches.astype("uint8"), (size, size), interpolation=cv2.INTER_NEAREST)]
+    scene = scene + rng.normal(0, 12, scene.shape)
+    return cv2.GaussianBlur(np.clip(scene, 0, 255).astype("uint8"), (5, 5), 0)
+
+
+def downscale(scene: np.ndarray) -> np.ndarray:
+    """
+    Same as SatelliteImage.prepare
+    """
+    return cv2.resize(scene, (200, 200), interpolation=cv2.INTER_AREA).reshape(-1, 3)
+
+
+def dominant_colors(
+    backend: ClusteringBackend,
+    scene: np.ndarray,
+    histogram_bits: int = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Dominant colors as reported by SatelliteImage, their percentages and the raw centers
+    """
+    if histogram_bits is None:
+        points = downscale(scene)
+        centers, labels = backend.fit(points)
+        percentages = np.bincount(labels, minlength=len(centers)) / len(points)
+    else:
+        colors, counts = color_histogram(scene.reshape(-1, 3), histogram_bits)
+        centers, labels = backend.fit(colors, counts)
+        percentages = np.bincount(labels, weights=counts, minlength=len(centers)) / counts.sum()
+    return np.array(centers, dtype="uint").astype("int64"), percentages, centers
+
+
+def inertia(points: np.ndarray, centers: np.ndarray) -> float:
+    """
+    Clustering inertia of the 200x200 pixels with the given centers
+    """
+    dist = ((points[:, np.newaxis].astype("float64") - centers[np.newaxis]) ** 2).sum(axis=2)
+    return dist.min(axis=1).sum()
+
+
+def deviation(reference: tuple, result: tuple) -> tuple[int, float]:
+    """
+    Largest color (RGB levels) and percentage (points) differences, clusters matched in the best order
+    """
+    best = None
+    for order in itertools.permutations(range(len(reference[0]))):
+        order = list(order)
+        color_diff = np.abs(reference[0] - result[0][order]).max()
+        percent_diff = np.abs(reference[1] - result[1][order]).max() * 100
+        if best is None or (color_diff, percent_diff) < best:
+            best = (color_diff, percent_diff)
+    return best
+
+
+def main(nb_scenes: int = 10) -> None:
+    rng = np.random.default_rng(0)
+    scenes = [synthetic_scene(rng) for _ in range(nb_scenes)]
+    # warm start runs on pairs of images of the same site, the second one slightly changed
+    pairs = [
+        (scene, np.clip(scene.astype("int16") + rng.integers(-6, 7, 3), 0, 255).astype("uint8"))
+        for scene in scenes
+    ]
+
+    reference = SklearnBackend()
+    references = [[dominant_colors(reference, img) for img in pair] for pair in pairs]
+
+    analyses = [("sklearn (random_state=1)", SklearnBackend(random_state=1), None)]  # seed sensitivity
+    for histogram_bits in (None, 6):
+        mode = "pixels" if histogram_bits is None else f"histogram {histogram_bits} bits"
+        for backend in BACKENDS.values():
+            analyses.append((f"{backend.name}, {mode}", backend(), histogram_bits))
+            analyses.append((f"{backend.name}+warm_start, {mode}", WarmStart(backend()), histogram_bits))
+
+    print(f"{nb_scenes} pairs of 1000x1000 scenes, deviations from sklearn's KMeans on 200x200 pixels")
+    for name, backend, histogram_bits in analyses:
+        timings, color_diffs, percent_diffs, inertia_ratios = [], [], [], []
+        for pair, pair_references in zip(pairs, references):
+            if isinstance(backend, WarmStart):
+                backend.reset()
+            for img, img_reference in zip(pair, pair_references):
+                start = time.perf_counter()
+                result = dominant_colors(backend, img, histogram_bits)
+                timings.append(time.perf_counter() - start)
+                color_diff, percent_diff = deviation(img_reference, result)
+                color_diffs.append(color_diff)
+                percent_diffs.append(percent_diff)
+                points = downscale(img)
+                inertia_ratios.append(inertia(points, result[2]) / inertia(points, img_reference[2]))
+        same = np.mean((np.array(color_diffs) <= 2) & (np.array(percent_diffs) <= 1))
+        print(
+            f"{name:>36}: {np.mean(timings)*1000:6.1f} ms per image, "
+            f"{same:4.0%} of images within 2 levels and 1 point, "
+            f"inertia at most {max(inertia_ratios) - 1:+6.1%} (median {np.median(inertia_ratios) - 1:+6.2%})"
+        )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,73 @@
+"""
+Compares the scene loader of SatelliteImage with the former one on a synthetic scene,
+shaped and typed like a GEE download (one float64 field per band)
+
+python benchmark_loader.py [size]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from image_analysis import read_scene, to_uint8_rgb
+
+
+def legacy_loader(filename: str) -> np.ndarray:
+    """
+    Former implementation: full read, conversion through Python floats, full-size temporaries
+    """
+    arr = np.load(filename)
+    arr = np.array(arr.tolist())
+    arr = np.clip(arr, 0, 0.3)
+    arr = 255 * (arr / 0.3)
+    return arr.astype('uint8')
+
+
+def loader(filename: str) -> np.ndarray:
+    return to_uint8_rgb(read_scene(filename), "float")
+
+
+def measure(load, filename: str, repeat: int) -> tuple[float, float, np.ndarray]:
+    """
+    Best time over repeat runs (in s) and peak memory allocated by one run (in MB)
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = load(filename)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    load(filename)
+    peak = tracemalloc.get_traced_memory()[1] / 1024**2
+    tracemalloc.stop()
+
+    return min(timings), peak, result
+
+
+def main(size: int = 1000, repeat: int = 3) -> None:
+    rng = np.random.default_rng(0)
+    scene = np.empty((size, size), dtype=[('SR_B4', "<f8"), ('SR_B3', "<f8"), ('SR_B2', "<f8")])
+    for band in scene.dtype.names:
+        scene[band] = rng.uniform(-0.05, 0.4, (size, size))
+
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, "scene.arr")
+        np.save(filename, scene)
+        os.replace(filename + ".npy", filename)
+
+        legacy_time, legacy_peak, legacy_result = measure(legacy_loader, filename, repeat)
+        new_time, new_peak, new_result = measure(loader, filename, repeat)
+
+    print(f"{size}x{size} scene, {scene.nbytes / 1024**2:.1f} MB on disk")
+    print(f"legacy loader: {legacy_time*1000:8.1f} ms, peak {legacy_peak:7.1f} MB")
+    print(f"memmap loader: {new_time*1000:8.1f} ms, peak {new_peak:7.1f} MB")
+    print(f"speedup x{legacy_time / new_time:.1f}, peak memory x{legacy_peak / new_peak:.1f} lower")
+    print(f"identical output: {np.array_equal(legacy_result, new_result)}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    """
+    Hard links are instantaneous and free, a copy is only made across filesystems
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class SceneCache():
+    """
+    Persistent on-disk cache of downloaded satellite scenes
+    Entries are addressed by the scene ID and the request parameters (AOI, dimensions, format)
+    so that a scene is never downloaded twice, the least recently used ones are evicted
+    once the cache grows beyond its size budget
+    """
+    def __init__(self, folder: str, max_size_mb: float) -> None:
+        self.folder = folder
+        self.max_size = int(max_size_mb * 1024**2)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return (
+            f"SceneCache(folder={self.folder}, max_size={self.max_size}, "
+            f"hits={self.hits}, misses={self.misses})"
+        )
+
+    @staticmethod
+    def make_key(scene_id: str, aoi: list, dimensions: str, file_format: str, bands: tuple) -> str:
+        description = json.dumps([scene_id, aoi, dimensions, file_format, list(bands)])
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.folder, key + ".arr")
+
+    def get(self, key: str, filename: str) -> bool:
+        """
+        Places the cached scene at filename if there is one
+        Touching the entry marks it as the most recently used
+        """
+        entry_path = self._entry_path(key)
+        try:
+            os.utime(entry_path)
+            _link_or_copy(entry_path, filename)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+
+        with self._lock:
+            self.hits += 1
+        logging.info(f"Scene cache hit: {filename} <- {entry_path}")
+        return True
+
+    def load(self, key: str) -> np.ndarray:
+        """
+        Reads the cached scene directly as a numpy array, None if it is not cached
+        Entries that are not .npy payloads (GeoTIFF) are returned as their raw bytes
+        """
+        entry_path = self._entry_path(key)
+        try:
+            os.utime(entry_path)
+            with open(entry_path, "rb") as f:
+                if f.read(6) == b"\x93NUMPY":
+                    f.seek(0)
+                    arr = np.lib.format.read_array(f)
+                else:
+                    arr = np.fromfile(entry_path, dtype=np.uint8)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        logging.info(f"Scene cache hit: {entry_path}")
+        return arr
+
+    def put(self, key: str, filename: str) -> None:
+        """
+        Stores a freshly downloaded scene, then evicts old entries if the budget is exceeded
+        """
+        entry_path = self._entry_path(key)
+        tmp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        _link_or_copy(filename, tmp_path)
+        os.replace(tmp_path, entry_path) # atomic, readers never see a partial entry
+        self.evict()
+
+    def put_array(self, key: str, arr: np.ndarray) -> None:
+        """
+        Stores a scene that was downloaded in memory only
+        """
+        entry_path = self._entry_path(key)
+        tmp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.lib.format.write_array(f, arr)
+        os.replace(tmp_path, entry_path)
+        self.evict()
+
+    def put_bytes(self, key: str, content: bytes) -> None:
+        """
+        Stores the raw bytes of a scene that was downloaded in memory only
+        """
+        entry_path = self._entry_path(key)
+        tmp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, entry_path)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits in its size budget
+        """
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".arr"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                logging.info(f"Scene cache eviction: {path}")
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def log_stats(self) -> None:
+        logging.info(f"Scene cache: {self.hits} hit(s), {self.misses} miss(es)")
+
+
+class WeatherCache():
+    """
+    Cache of weather forecasts that expire after ttl seconds
+    Sites are grouped in grid cells of cell_size degrees, neighbors share the same forecast
+    Entries are kept in memory, and also in a folder (one JSON file per cell) if one is given
+    """
+    def __init__(self, cell_size: float, ttl: float, folder: str = None) -> None:
+        self.cell_size = cell_size
+        self.ttl = ttl
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        if self.folder:
+            os.makedirs(self.folder, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return (
+            f"WeatherCache(cell_size={self.cell_size}, ttl={self.ttl}, folder={self.folder}, "
+            f"hits={self.hits}, misses={self.misses})"
+        )
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return round(lat / self.cell_size), round(lon / self.cell_size)
+
+    def _entry_path(self, cell: tuple[int, int]) -> str:
+        return os.path.join(self.folder, f"weather_{self.cell_size}_{cell[0]}_{cell[1]}.json")
+
+    def get(self, lat: float, lon: float) -> dict:
+        """
+        Returns the forecast of the cell containing lat/lon, None if there is none or if it expired
+        """
+        cell = self._cell(lat, lon)
+        with self._lock:
+            entry = self._entries.get(cell)
+        if entry is None and self.folder:
+            try:
+                with open(self._entry_path(cell), encoding="utf8") as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                entry = None
+
+        with self._lock:
+            if entry is None or time.time() - entry['fetched_at'] > self.ttl:
+                self._entries.pop(cell, None)
+                self.misses += 1
+                return None
+            self._entries[cell] = entry
+            self.hits += 1
+        return entry['data']
+
+    def put(self, lat: float, lon: float, data: dict) -> None:
+        cell = self._cell(lat, lon)
+        entry = {'fetched_at': time.time(), 'data': data}
+        with self._lock:
+            self._entries[cell] = entry
+        if self.folder:
+            entry_path = self._entry_path(cell)
+            tmp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, entry_path)
+
+    def log_stats(self) -> None:
+        logging.info(f"Weather cache: {self.hits} hit(s), {self.misses} miss(es)")
@@ -0,0 +1,111 @@
+import logging
+
+import cv2
+import matplotlib.pyplot as plt
+import numpy as np
+from PIL import Image
+
+from resources import Resource, save_image
+
+
+# log(level + 1) of every uint8 level, the per-pixel ratios become sums of table lookups
+LOG_LEVELS = np.log1p(np.arange(256, dtype="float32"))
+# log change from which a pixel is counted as drier (or greener), i.e. a 25% change of the dryness
+CHANGE_THRESHOLD = np.log(1.25)
+
+
+def align(recent: np.ndarray, oldest: np.ndarray, interpolation: int = cv2.INTER_AREA) -> np.ndarray:
+    """
+    Resamples the oldest image (or mask) on the grid of the most recent one (both cover the same AoI)
+    Images downloaded with the same dimensions or scale are already aligned and returned as is
+    """
+    if oldest.shape[:2] == recent.shape[:2]:
+        return oldest
+    logging.info(f"Resampling the oldest image from {oldest.shape[:2]} to {recent.shape[:2]}")
+    return cv2.resize(oldest, (recent.shape[1], recent.shape[0]), interpolation=interpolation)
+
+
+class ChangeMap():
+    """
+    Per-pixel dryness change between the two RGB images (uint8 (h, w, 3) arrays) of a site, most recent first
+    Same formula as RiskModel.dryness applied to every pixel instead of to pairs of dominant colors:
+    (r_recent / r_oldest) * (g_oldest / g_recent), levels offset by 1 so that black pixels stay finite
+    map holds its natural log as float32: 0 where nothing changed, positive where the site got drier,
+    negative where it got greener, NaN where an image has no data (black pixel) or is masked
+    (masks are True where a pixel is clear, see cloud_mask.clear_mask)
+    The map is computed tile_rows rows at a time, with no temporary larger than a tile
+    """
+    def __init__(
+        self,
+        recent: np.ndarray,
+        oldest: np.ndarray,
+        tile_rows: int = 256,
+        recent_mask: np.ndarray = None,
+        oldest_mask: np.ndarray = None,
+    ) -> None:
+        oldest = align(recent, oldest)
+        if oldest_mask is not None:
+            oldest_mask = align(recent, oldest_mask.view(np.uint8), cv2.INTER_NEAREST).view(np.bool_)
+        height, width, _ = recent.shape
+        self.tile_rows = tile_rows
+        self.map = np.empty((height, width), dtype="float32")
+
+        valid_count = 0
+        log_sum = 0.0
+        drier = greener = 0
+        for start in range(0, height, tile_rows):
+            recent_tile = recent[start:start+tile_rows]
+            oldest_tile = oldest[start:start+tile_rows]
+            tile = self.map[start:start+tile_rows]
+            np.take(LOG_LEVELS, recent_tile[..., 0], out=tile)
+            tile -= LOG_LEVELS[oldest_tile[..., 0]]
+            tile += LOG_LEVELS[oldest_tile[..., 1]]
+            tile -= LOG_LEVELS[recent_tile[..., 1]]
+
+            valid = recent_tile.any(axis=-1) & oldest_tile.any(axis=-1)
+            if recent_mask is not None:
+                valid &= recent_mask[start:start+tile_rows]
+            if oldest_mask is not None:
+                valid &= oldest_mask[start:start+tile_rows]
+            tile[~valid] = np.nan
+            valid_tile = tile[valid]
+            valid_count += valid_tile.size
+            log_sum += valid_tile.sum(dtype="float64")
+            drier += np.count_nonzero(valid_tile > CHANGE_THRESHOLD)
+            greener += np.count_nonzero(valid_tile < -CHANGE_THRESHOLD)
+
+        mean_log = log_sum / valid_count if valid_count else np.nan
+        self.stats = {
+            'valid': float(valid_count / self.map.size),
+            # geometric mean of the per-pixel dryness, 1 when nothing changed on average
+            'dryness': float(np.exp(mean_log)),
+            'drier': float(drier / valid_count) if valid_count else np.nan,
+            'greener': float(greener / valid_count) if valid_count else np.nan,
+        }
+        logging.info(f"Change map: {self.stats}")
+
+    def __repr__(self) -> str:
+        return f"ChangeMap(shape={self.map.shape}, tile_rows={self.tile_rows}, stats={self.stats})"
+
+    def make_overlay(
+        self,
+        background: np.ndarray,
+        filename: str,
+        in_memory: bool = False,
+        max_change: float = np.log(2),
+    ) -> Resource:
+        """
+        Draws the map over an RGB image of the site: red where drier, green where greener,
+        transparent where nothing changed, fully opaque from a log change of max_change
+        """
+        palette = (plt.get_cmap("RdYlGn_r")(np.linspace(0, 1, 256))[:, :3] * 255).astype("float32")
+        overlay = np.empty(background.shape, dtype="uint8")
+        for start in range(0, len(self.map), self.tile_rows):
+            level = np.nan_to_num(self.map[start:start+self.tile_rows] / max_change, nan=0.0)
+            np.clip(level, -1, 1, out=level)
+            colors = palette[np.rint((level + 1) * 127.5).astype("uint8")]
+            alpha = np.abs(level)[..., np.newaxis]
+            blended = background[start:start+self.tile_rows] * (1 - alpha) + colors * alpha
+            np.copyto(overlay[start:start+self.tile_rows], blended, casting="unsafe")
+
+        return save_image(Image.fromarray(overlay, 'RGB'), filename, in_memory)
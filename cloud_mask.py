@@ -0,0 +1,23 @@
+import numpy as np
+
+
+# Landsat Collection 2 pixel quality band, downloaded as raw uint16 bit flags
+QA_BAND = "QA_PIXEL"
+FILL_BIT = 0
+DILATED_CLOUD_BIT = 1
+CIRRUS_BIT = 2
+CLOUD_BIT = 3
+CLOUD_SHADOW_BIT = 4
+SNOW_BIT = 5
+# flags of the pixels left out of the analysis
+MASKED_BITS = (FILL_BIT, DILATED_CLOUD_BIT, CLOUD_BIT, CLOUD_SHADOW_BIT)
+
+
+def clear_mask(qa: np.ndarray, bits: tuple[int, ...] = MASKED_BITS) -> np.ndarray:
+    """
+    True where none of the given QA_PIXEL flags is set, for a QA band array or a download holding it
+    """
+    if qa.dtype.names is not None:
+        qa = qa[QA_BAND]
+    flags = np.uint16(sum(1 << bit for bit in bits))
+    return (qa & flags) == 0
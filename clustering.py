@@ -0,0 +1,264 @@
+import logging
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+
+class ClusteringBackend():
+    """
+    Finds the dominant colors of a set of RGB points (n, 3), optionally weighted
+    fit returns the centers (k, 3) and the label of every point (n,)
+    init gives starting centers, otherwise they are chosen by the backend
+    """
+    name = None
+
+    def __init__(self, n_clusters: int = 3, random_state: int = 0) -> None:
+        self.n_clusters = n_clusters
+        self.random_state = random_state
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(n_clusters={self.n_clusters}, random_state={self.random_state})"
+
+    def fit(
+        self,
+        points: np.ndarray,
+        weights: np.ndarray = None,
+        init: np.ndarray = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        raise NotImplementedError
+
+
+class SklearnBackend(ClusteringBackend):
+    """
+    sklearn's KMeans, the reference implementation
+    """
+    name = "sklearn"
+
+    def fit(self, points, weights=None, init=None):
+        if init is None:
+            kmeans = KMeans(n_clusters=self.n_clusters, random_state=self.random_state)
+        else:
+            kmeans = KMeans(n_clusters=self.n_clusters, init=init, n_init=1, random_state=self.random_state)
+        kmeans.fit(points, sample_weight=weights)
+        return kmeans.cluster_centers_, kmeans.labels_
+
+
+class MiniBatchBackend(ClusteringBackend):
+    """
+    sklearn's MiniBatchKMeans, centers are updated from random batches of points
+    """
+    name = "minibatch"
+
+    def __init__(self, n_clusters: int = 3, random_state: int = 0, batch_size: int = 4096) -> None:
+        super().__init__(n_clusters, random_state)
+        self.batch_size = batch_size
+
+    def fit(self, points, weights=None, init=None):
+        kmeans = MiniBatchKMeans(
+            n_clusters=self.n_clusters,
+            init="k-means++" if init is None else init,
+            n_init=1,
+            batch_size=self.batch_size,
+            random_state=self.random_state,
+        )
+        kmeans.fit(points, sample_weight=weights)
+        return kmeans.cluster_centers_, kmeans.labels_
+
+
+class NumpyBackend(ClusteringBackend):
+    """
+    Lean Lloyd's algorithm for a few clusters in RGB space, started from k-means++ centers
+    Distances are computed in float32 with a single matrix product per iteration
+    """
+    name = "numpy"
+
+    def __init__(
+        self,
+        n_clusters: int = 3,
+        random_state: int = 0,
+        max_iter: int = 100,
+        tol: float = 1e-2,
+    ) -> None:
+        super().__init__(n_clusters, random_state)
+        self.max_iter = max_iter
+        self.tol = tol
+
+    def _kmeans_plus_plus(self, points: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """
+        Greedy k-means++ (as in sklearn): every new center is the best of a few candidates
+        drawn with a probability proportional to their squared distance to the closest center
+        """
+        rng = np.random.default_rng(self.random_state)
+        n_local_trials = 2 + int(np.log(self.n_clusters))
+
+        def draw(p: np.ndarray, size: int) -> np.ndarray:
+            cumulative = np.cumsum(p)
+            return np.minimum(np.searchsorted(cumulative, rng.random(size) * cumulative[-1]), len(p) - 1)
+
+        centers = [points[draw(weights, 1)[0]]]
+        min_dist = ((points - centers[0]) ** 2).sum(axis=1)
+        for _ in range(1, self.n_clusters):
+            p = weights * min_dist
+            if p.sum() == 0: # fewer distinct colors than clusters
+                centers.append(centers[-1])
+                continue
+            candidates = points[draw(p, n_local_trials)]
+            candidate_dist = np.minimum(
+                min_dist,
+                (candidates ** 2).sum(axis=1)[:, np.newaxis]
+                - 2 * candidates @ points.T
+                + (points ** 2).sum(axis=1),
+            )
+            best = (candidate_dist @ weights).argmin()
+            centers.append(candidates[best])
+            min_dist = candidate_dist[best]
+        return np.array(centers)
+
+    @staticmethod
+    def _labels(points: np.ndarray, centers: np.ndarray) -> np.ndarray:
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, |x|^2 is the same for every center and does not change the argmin
+        return ((centers ** 2).sum(axis=1) - 2 * points @ centers.T).argmin(axis=1)
+
+    def fit(self, points, weights=None, init=None):
+        points = np.asarray(points, dtype="float32")
+        weights = (
+            np.ones(len(points), dtype="float64") if weights is None
+            else np.asarray(weights, dtype="float64")
+        )
+        weighted_channels = np.ascontiguousarray((points * weights[:, np.newaxis]).T, dtype="float64")
+        centers = (
+            self._kmeans_plus_plus(points, weights) if init is None
+            else np.array(init, dtype="float32")
+        )
+
+        for i in range(self.max_iter):
+            labels = self._labels(points, centers)
+            totals = np.bincount(labels, weights=weights, minlength=self.n_clusters)
+            occupied = totals > 0 # an empty cluster keeps its previous center
+            new_centers = centers.copy()
+            for channel, weighted_channel in enumerate(weighted_channels):
+                sums = np.bincount(labels, weights=weighted_channel, minlength=self.n_clusters)
+                new_centers[occupied, channel] = sums[occupied] / totals[occupied]
+            shift = np.abs(new_centers - centers).max()
+            centers = new_centers
+            if shift <= self.tol:
+                break
+        logging.info(f"Lloyd's algorithm converged in {i+1} iteration(s)")
+
+        return centers.astype("float64"), self._labels(points, centers)
+
+
+class WarmStart(ClusteringBackend):
+    """
+    Starts every fit from the centers found by the previous one
+    Two images of the same site have close dominant colors, so the second fit converges quickly
+    reset must be called before the first image of every site, so that results never depend on
+    the site analyzed before
+    """
+    def __init__(self, backend: ClusteringBackend) -> None:
+        super().__init__(backend.n_clusters, backend.random_state)
+        self.backend = backend
+        self.name = f"{backend.name}+warm_start"
+        self._centers = None
+
+    def __repr__(self) -> str:
+        return f"WarmStart({self.backend})"
+
+    def reset(self) -> None:
+        self._centers = None
+
+    def fit(self, points, weights=None, init=None):
+        centers, labels = self.backend.fit(
+            points, weights, init if init is not None else self._centers
+        )
+        self._centers = centers
+        return centers, labels
+
+
+class StreamingKMeans():
+    """
+    Lloyd's algorithm over every pixel of an image too large to be clustered at once (e.g. a memmap)
+    Each pass reads the pixels chunk_size at a time and only accumulates per-cluster sums and counts,
+    so memory depends on the chunk size, not on the image size
+    The starting centers are found by a clustering backend on a regular sample of chunk_size pixels
+    """
+    def __init__(
+        self,
+        init_backend: ClusteringBackend = None,
+        chunk_size: int = 1 << 18,
+        passes: int = 10,
+        tol: float = 1e-2,
+    ) -> None:
+        self.init_backend = init_backend if init_backend is not None else SklearnBackend()
+        self.n_clusters = self.init_backend.n_clusters
+        self.chunk_size = chunk_size
+        self.passes = passes
+        self.tol = tol
+
+    def __repr__(self) -> str:
+        return (
+            f"StreamingKMeans(init_backend={self.init_backend}, chunk_size={self.chunk_size}, "
+            f"passes={self.passes}, tol={self.tol})"
+        )
+
+    def _pass(
+        self, points: np.ndarray, centers: np.ndarray, mask: np.ndarray = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Per-cluster sums (k, 3) and counts (k,) of the points assigned to the nearest center
+        With a mask (n,), only the points where it is True are assigned, chunk by chunk
+        """
+        sums = np.zeros((self.n_clusters, points.shape[1]), dtype="float64")
+        counts = np.zeros(self.n_clusters, dtype="int64")
+        for start in range(0, len(points), self.chunk_size):
+            chunk = points[start:start+self.chunk_size]
+            if mask is not None:
+                chunk = chunk[mask[start:start+self.chunk_size]]
+            chunk = np.asarray(chunk, dtype="float32")
+            labels = NumpyBackend._labels(chunk, centers)
+            counts += np.bincount(labels, minlength=self.n_clusters)
+            for channel in range(chunk.shape[1]):
+                sums[:, channel] += np.bincount(labels, weights=chunk[:, channel], minlength=self.n_clusters)
+        return sums, counts
+
+    def fit(self, points: np.ndarray, mask: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the centers (k, 3) and the number of points (k,) assigned to each of them
+        With a mask (n,), the points where it is False are left out
+        """
+        step = max(1, len(points) // self.chunk_size)
+        sample = points[::step][:self.chunk_size]
+        if mask is not None:
+            sample = sample[mask[::step][:self.chunk_size]]
+        centers, _ = self.init_backend.fit(np.asarray(sample))
+        centers = np.asarray(centers, dtype="float32")
+
+        for i in range(self.passes):
+            sums, counts = self._pass(points, centers, mask)
+            occupied = counts > 0 # an empty cluster keeps its previous center
+            new_centers = centers.copy()
+            new_centers[occupied] = sums[occupied] / counts[occupied, np.newaxis]
+            shift = np.abs(new_centers - centers).max()
+            centers = new_centers
+            if shift <= self.tol:
+                break
+        logging.info(f"Streaming k-means stopped after {i+1} pass(es) over {counts.sum()} points")
+
+        # the counts of the last pass were measured with the previous centers
+        _, counts = self._pass(points, centers, mask)
+        return centers.astype("float64"), counts
+
+
+BACKENDS = {
+    backend.name: backend for backend in (SklearnBackend, MiniBatchBackend, NumpyBackend)
+}
+
+
+def make_clustering_backend(name: str, n_clusters: int = 3, warm_start: bool = False) -> ClusteringBackend:
+    """
+    name is one of "sklearn", "minibatch" or "numpy"
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown clustering backend: {name} (expected one of {', '.join(BACKENDS)})")
+    backend = BACKENDS[name](n_clusters)
+    return WarmStart(backend) if warm_start else backend
@@ -1,255 +1,936 @@
+import io
+import json
 import logging
-import math
+import os
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Any, Callable
 
+import cv2
 import ee
 import matplotlib.pyplot as plt
+import numpy as np
 import requests
-from requests.adapters import HTTPAdapter, Retry
+from requests.adapters import Retry
 from tqdm import tqdm
 
-from image_analysis import SatelliteImage
+from cache import SceneCache, WeatherCache
+from change_detection import ChangeMap, align
+from cloud_mask import QA_BAND, clear_mask
+from image_analysis import SatelliteImage, to_uint8_rgb
+from resources import Resource, save_figure
+from risk_model import RiskModel
+from spectral import SPECTRAL_BANDS, SpectralChange
+from tiling import AoiTiler, Tile
+from transport import LiveTransport
+from weather_store import WeatherStore
+
+
+def _parse_npy_header(buffer: bytes):
+    """
+    Reads the header at the beginning of a .npy payload
+    Returns (shape, fortran_order, dtype, data_offset) or None while the header is incomplete
+    """
+    if len(buffer) < 12:
+        return None
+    header_len_size = 2 if buffer[6] == 1 else 4
+    data_offset = 8 + header_len_size + int.from_bytes(buffer[8:8+header_len_size], "little")
+    if len(buffer) < data_offset:
+        return None
+
+    fp = io.BytesIO(buffer[:data_offset])
+    version = np.lib.format.read_magic(fp)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+    else:
+        raise ValueError(f"Unsupported .npy format version {version}")
+
+    return shape, fortran_order, dtype, data_offset
+
+
+# one row per forecast day, in the order of the API response
+FORECAST_DTYPE = np.dtype([
+    ('dt', "int64"),  # POSIX timestamp
+    ('temperature', "float64"),
+    ('humidity', "float64"),
+    ('wind', "float64"),
+    ('rain', "float64"),
+    ('rain_p', "float64"),
+    ('sunlight', "float64"),
+])
+
+
+def forecast_to_array(req_data: dict) -> np.ndarray:
+    """
+    Converts the daily forecast of a onecall response into a FORECAST_DTYPE array
+    """
+    return np.array(
+        [
+            (
+                day['dt'],
+                day['temp']['day'],
+                day['humidity'],
+                day['wind_speed'],
+                day.get('rain', 0),
+                day['pop'],
+                day['uvi'],
+            ) for day in req_data['daily']
+        ],
+        dtype=FORECAST_DTYPE,
+    )
 
 
 class CollectedData():
-    def __init__(self, lat: float, lon: float, weather_api_key: str, resources_folder: str) -> None:
-        # in case the user wants to generate several reports, initializing GEE can be skipped
-        if not getattr(self, 'established', False):
-            self.initialize_gee()
+    COLLECTION_ID = "LANDSAT/LC09/C02/T1_L2"
+    BANDS = ("SR_B4", "SR_B3", "SR_B2")
+    DIMENSIONS = "1000x1000" # 1365x1365 max resolution for authorized request size
+    # transfer formats of the scenes (see image_analysis.to_uint8_rgb) and their GEE file format
+    # float: scaled reflectance (legacy, biggest), dn: raw uint16 digital numbers (4x smaller),
+    # uint8: clipped and stretched by GEE (8x smaller), geotiff: same as uint8 but compressed
+    DOWNLOAD_FORMATS = {
+        'float': "npy",
+        'dn': "npy",
+        'uint8': "npy",
+        'geotiff': "GEO_TIFF",
+    }
+    DOWNLOAD_CHUNK_SIZE = 1024**2
+    # color: dryness from the dominant colors of both images
+    # spectral: dryness from the per-pixel change of the NDVI and NBR (see spectral.SpectralChange)
+    # change: dryness from the per-pixel change of the colors (see change_detection.ChangeMap)
+    DRYNESS_ENGINES = ("color", "spectral", "change")
+
+    def __init__(
+        self,
+        lat: float,
+        lon: float,
+        weather_api_key: str,
+        resources_folder: str,
+        scene_cache: SceneCache = None,
+        save_arrs: bool = True,
+        in_memory: bool = False,
+        transport: LiveTransport = None,
+        download_format: str = "float",
+        verify_download_format: bool = False,
+        aoi_size: float = 0.2,
+        scale: float = None,
+        tile_size: int = 1000,
+        tile_workers: int = 4,
+        weather_cache: WeatherCache = None,
+        weather_client: "WeatherClient" = None,
+        weather_store: WeatherStore = None,
+        dryness_engine: str = "color",
+        cloud_mask: bool = False,
+        max_cloud_cover: float = 55,
+    ) -> None:
+        if download_format not in self.DOWNLOAD_FORMATS:
+            raise ValueError(
+                f"Unknown download format: {download_format} (expected one of {', '.join(self.DOWNLOAD_FORMATS)})"
+            )
+        if dryness_engine not in self.DRYNESS_ENGINES:
+            raise ValueError(
+                f"Unknown dryness engine: {dryness_engine} (expected one of {', '.join(self.DRYNESS_ENGINES)})"
+            )
+        self._transport = transport if transport is not None else LiveTransport()
+        # in case the user wants to generate several reports, GEE is only initialized once
+        self._transport.initialize_gee()
         self.lat = lat
         self.lon = lon
         self._resources_folder = resources_folder
+        self._scene_cache = scene_cache
+        self._save_arrs = save_arrs
+        self._in_memory = in_memory
+        self.download_format = download_format
+        self.aoi_size = aoi_size
+        # with a scale (in meters per pixel), the region is downloaded tile by tile at this resolution
+        self.scale = scale
+        self._tile_size = tile_size
+        self._tile_workers = tile_workers
+        self.dryness_engine = dryness_engine
+        # with a cloud mask, cloud, shadow and fill pixels (QA_PIXEL flags) are left out of the analysis
+        self.cloud_mask = cloud_mask
+        self.max_cloud_cover = max_cloud_cover
+        self.spectral_change = None
+        self.change_map = None
+        self.NB_IMGS = 2
+        self.masks = [None] * self.NB_IMGS
+        self.gee_round_trips = 0
         self.indicators = {}
-        self.make_aoi()
-        self.get_most_recent_imgs()
-        self.get_imgs_download_url()
-        self.download_files()
-
-        self.imgs = []
-        for i, (arr_filename, gee_img_date) in enumerate(zip(self.arrs_filename, self.gee_imgs_date)):
-            new_img = SatelliteImage(
-                arr_filename,
-                gee_img_date,
-                i+1,
-                self._resources_folder
+        self._round_trips_lock = threading.Lock()
+
+        # the weather request does not depend on any GEE result, it runs while the images are collected
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            weather_future = executor.submit(
+                WeatherData,
+                self.lat,
+                self.lon,
+                weather_api_key,
+                self._resources_folder,
+                in_memory=self._in_memory,
+                transport=self._transport,
+                cache=weather_cache,
+                client=weather_client,
+                store=weather_store,
             )
-            self.imgs.append(new_img)
 
-        self.weather_data = WeatherData(self.lat, self.lon, weather_api_key, self._resources_folder)
+            self.make_aoi()
+            self.get_most_recent_imgs()
+            self.make_arrs_filename()
+            if self.scale:
+                self.download_mosaics()
+            else:
+                self.load_cached_files()
+                self.get_imgs_download_url()
+                self.download_files()
+                if self.cloud_mask:
+                    self.download_masks()
+
+            self.imgs = []
+            for i, (arr_filename, gee_img_date) in enumerate(zip(self.arrs_filename, self.gee_imgs_date)):
+                new_img = SatelliteImage(
+                    arr_filename,
+                    gee_img_date,
+                    i+1,
+                    self._resources_folder,
+                    raw_arr=self.raw_arrs[i],
+                    in_memory=self._in_memory,
+                    # mosaics are normalized tile by tile while downloading
+                    arr_format="uint8" if self.scale else self.download_format,
+                    mask=self.masks[i],
+                )
+                self.imgs.append(new_img)
+            # raw arrays are not needed anymore once normalized by SatelliteImage
+            self.raw_arrs = [None] * len(self.raw_arrs)
+
+            if verify_download_format and self.download_format != "float" and not self.scale:
+                self.verify_download_format()
+
+            if self.dryness_engine == "spectral":
+                self.compute_spectral_change()
+            elif self.dryness_engine == "change":
+                self.compute_change_map()
+
+            self.weather_data = weather_future.result()
 
     def __repr__(self) -> str:
         rep = self.__dict__.copy()
-        rep['aoi'] = "ee.Geometry.Polygon("+str(self.aoi.getInfo())+")"
-        rep['collection'] = "ee.ImageCollection(id="+self.collection.getInfo()['id']+")"
+        rep['aoi'] = "ee.Geometry.Polygon("+str(self.aoi_coords)+")"
+        rep['collection'] = "ee.ImageCollection(id="+self.COLLECTION_ID+")"
         return (
             f"CollectedData({', '.join([key+'='+str(val) for key, val in rep.items()])})"
         )
 
-    def initialize_gee(self) -> None:
-        # ee.Authenticate()
-        logging.info("Initializing Google Earth Engine...")
-        ee.Initialize()
-        logging.info("Google Earth Engine initialized successfully!")
-        self.established = True
-
-    def make_aoi(self) -> ee.Geometry.Polygon:
-        """
-        Making the Area of Interest object to use the GEE library
-        """
-        self.aoi = ee.Geometry.Polygon(
-            [[
-                [self.lon-0.1, self.lat+0.1],
-                [self.lon-0.1, self.lat-0.1],
-                [self.lon+0.1, self.lat-0.1],
-                [self.lon+0.1, self.lat-0.1],
-            ]],
-            None,
-            False
+    def make_aoi(self) -> list:
+        """
+        Making the coordinates of the Area of Interest, a square of aoi_size degrees
+        The GEE object itself (self.aoi) is only built when a request needs it
+        """
+        half_size = self.aoi_size / 2
+        self.aoi_bounds = (
+            self.lon - half_size,
+            self.lat - half_size,
+            self.lon + half_size,
+            self.lat + half_size,
         )
-        return self.aoi
+        west, south, east, north = self.aoi_bounds
+        self.aoi_coords = [[
+            [west, north],
+            [west, south],
+            [east, south],
+            [east, north],
+        ]]
+        return self.aoi_coords
 
-    def get_gee_img_date(self, gee_img: ee.Image) -> datetime:
-        timestamp = gee_img.getInfo()['properties']['system:time_start']
-        return datetime.fromtimestamp(timestamp/1000)
+    @property
+    def aoi(self) -> ee.Geometry.Polygon:
+        return ee.Geometry.Polygon(self.aoi_coords, None, False)
 
-    def __remove_duplicate_dates(self, list_of_imgs: ee.List) -> ee.List:
+    @property
+    def collection(self) -> ee.ImageCollection:
+        return (
+            ee.ImageCollection(self.COLLECTION_ID)
+            .filterBounds(self.aoi)
+            .filter(f"CLOUD_COVER < {self.max_cloud_cover}")
+            .sort('CLOUD_COVER')
+            .sort('system:time_start', False)
+        )
+
+    @property
+    def gee_imgs(self) -> tuple[ee.Image, ...]:
+        return tuple(
+            self._make_download_img(scene_id, self.download_format) for scene_id in self.scene_ids
+        )
+
+    def _gee_request(self, key: list, request: Callable[[], Any]) -> Any:
         """
-        Removing images that have the same date
-        This case happends when the AoI lies between two tiles
+        Every blocking request to GEE goes through the transport here so that round-trips can be counted
+        key describes the request with plain values (no ee object), so that it can be replayed offline
         """
-        already_seen_dates = set()
-        cleaned_img_list = ee.List([])
+        with self._round_trips_lock:
+            self.gee_round_trips += 1
+        return self._transport.gee_request(json.dumps(key), request)
 
-        for i in range(list_of_imgs.size().getInfo()):
-            date_acquired = list_of_imgs.get(i).getInfo()['properties']['DATE_ACQUIRED']
-            if date_acquired not in already_seen_dates:
-                cleaned_img_list = cleaned_img_list.add(list_of_imgs.get(i))
-                already_seen_dates.add(date_acquired)
+    @staticmethod
+    def applyScaleFactors(image: ee.Image) -> ee.Image:
+        opticalBands = image.select('SR_B.').multiply(0.0000275).add(-0.2);
+        thermalBands = image.select('ST_B.*').multiply(0.00341802).add(149.0);
+        return image.addBands(opticalBands, None, True).addBands(thermalBands, None, True);
 
-        return cleaned_img_list
+    def __remove_duplicate_dates(self, collection: ee.ImageCollection) -> ee.ImageCollection:
+        """
+        Removing images that have the same date, entirely server-side
+        This case happends when the AoI lies between two tiles
+        """
+        return collection.distinct('DATE_ACQUIRED').sort('system:time_start', False)
 
-    def get_most_recent_imgs(self) -> tuple[ee.Image, ee.Image]:
+    def get_most_recent_imgs(self) -> tuple[str, ...]:
         """
         Query GEE library to get the 2 most recend and clearest images
+        De-duplication and selection are evaluated by GEE, only one round-trip is needed
+        whatever the size of the collection
         A dataset-specific scale factor is also applied
         """
-        self.collection = (
-            ee.ImageCollection("LANDSAT/LC09/C02/T1_L2")
-            .filterBounds(self.aoi)
-            .filter("CLOUD_COVER < 55")
-            .sort('CLOUD_COVER')
-            .sort('system:time_start', False)
-        )
+        def request() -> dict:
+            most_recent = self.__remove_duplicate_dates(self.collection).limit(self.NB_IMGS)
+            return ee.Dictionary({
+                'ids': most_recent.aggregate_array('system:index'),
+                'timestamps': most_recent.aggregate_array('system:time_start'),
+            }).getInfo()
 
-        def applyScaleFactors(image):
-            opticalBands = image.select('SR_B.').multiply(0.0000275).add(-0.2);
-            thermalBands = image.select('ST_B.*').multiply(0.00341802).add(149.0);
-            return image.addBands(opticalBands, None, True).addBands(thermalBands, None, True);
+        scenes_info = self._gee_request(
+            ["scenes", self.COLLECTION_ID, self.aoi_coords, self.NB_IMGS, self.max_cloud_cover],
+            request,
+        )
 
-        self.collection = self.collection.map(applyScaleFactors)
+        if len(scenes_info['ids']) < self.NB_IMGS:
+            raise ValueError(
+                f"Could not find enough images for further analysis (<{self.NB_IMGS} images)"
+            )
 
-        list_of_imgs = self.collection.toList(self.collection.size().getInfo())
-        list_of_imgs = self.__remove_duplicate_dates(list_of_imgs)
+        self.scene_ids = tuple(scenes_info['ids'])
+        self.gee_imgs_date = tuple(
+            datetime.fromtimestamp(timestamp/1000) for timestamp in scenes_info['timestamps']
+        )
+        logging.info(f"Found scenes {self.scene_ids} after {self.gee_round_trips} GEE round-trip(s)")
 
-        if list_of_imgs.size().getInfo() < 2:
-            raise ValueError("Could not find enough images for further analysis (<2 images)")
+        return self.scene_ids
 
-        self.gee_imgs = (
-            ee.Image(list_of_imgs.get(0)).select("SR_B4", "SR_B3", "SR_B2"),
-            ee.Image(list_of_imgs.get(1)).select("SR_B4", "SR_B3", "SR_B2"),
-        )
-        self.gee_imgs_date = (
-            self.get_gee_img_date(self.gee_imgs[0]),
-            self.get_gee_img_date(self.gee_imgs[1]),
+    def _scene_img(self, scene_id: str) -> ee.Image:
+        if not self.scale:
+            return ee.Image(f"{self.COLLECTION_ID}/{scene_id}")
+        # a large region can straddle several Landsat scenes acquired the same day (scene ids end with the date)
+        date = scene_id[-8:]
+        return (
+            ee.ImageCollection(self.COLLECTION_ID)
+            .filterBounds(self.aoi)
+            .filter(ee.Filter.eq('DATE_ACQUIRED', f"{date[:4]}-{date[4:6]}-{date[6:]}"))
+            .mosaic()
         )
 
-        return self.gee_imgs
+    def _make_download_img(self, scene_id: str, download_format: str, bands: tuple = None) -> ee.Image:
+        bands = bands or self.BANDS
+        img = self._scene_img(scene_id)
+        if download_format == "dn":
+            return img.select(*bands)
+        img = self.applyScaleFactors(img).select(*bands)
+        if download_format in ("uint8", "geotiff"):
+            # same clip and stretch as image_analysis.to_uint8_rgb, computed by GEE
+            img = img.clamp(0, 0.3).divide(0.3).multiply(255).toUint8()
+        return img
 
-    def get_imgs_download_url(self) -> list[str]:
-        self.imgs_url = []
-        for sat_img in self.gee_imgs:
-            self.imgs_url.append(
-                sat_img.getDownloadURL(
-                    {
-                        'region': self.aoi,
-                        'dimensions': "1000x1000", # 1365x1365 max resolution for authorized request size
-                        'format': "npy",
-                    }
-                )
+    def _get_img_download_url(
+        self, scene_id: str, download_format: str = None, tile: Tile = None, bands: tuple = None
+    ) -> str:
+        """
+        Without a tile, the whole AoI is requested at the fixed DIMENSIONS
+        A tile is requested on its own EPSG:4326 grid, at the resolution of the tiler
+        """
+        download_format = download_format or self.download_format
+        bands = bands or self.BANDS
+        if tile is None:
+            grid_key = [self.aoi_coords, self.DIMENSIONS]
+        else:
+            grid_key = [tile.crs_transform, f"{tile.cols}x{tile.rows}"]
+
+        def request() -> str:
+            sat_img = self._make_download_img(scene_id, download_format, bands)
+            if tile is None:
+                grid = {'region': self.aoi, 'dimensions': self.DIMENSIONS}
+            else:
+                grid = {
+                    'crs': "EPSG:4326",
+                    'crs_transform': tile.crs_transform,
+                    'dimensions': f"{tile.cols}x{tile.rows}",
+                }
+            return sat_img.getDownloadURL(
+                {
+                    **grid,
+                    'format': self.DOWNLOAD_FORMATS[download_format],
+                }
             )
-            logging.info(f"Found URL successfully: {self.imgs_url[-1]}")
+
+        img_url = self._gee_request(
+            ["download_url", scene_id, *grid_key, download_format, bands],
+            request,
+        )
+        logging.info(f"Found URL successfully: {img_url}")
+        return img_url
+
+    def get_imgs_download_url(self) -> list[str]:
+        """
+        Requesting the download URLs of all the images at once, each lookup is a GEE round-trip
+        Images already found in the scene cache are skipped (their URL is None)
+        """
+        to_download = [
+            scene_id for scene_id, is_cached in zip(self.scene_ids, self.is_cached) if not is_cached
+        ]
+        urls = iter([])
+        if to_download:
+            with ThreadPoolExecutor(max_workers=len(to_download)) as executor:
+                urls = executor.map(self._get_img_download_url, to_download)
+
+        self.imgs_url = [None if is_cached else next(urls) for is_cached in self.is_cached]
 
         return self.imgs_url
 
-    def __gee_request_to_save(self, s: requests.sessions.Session, url: str, filename: str) -> None:
+    def make_arrs_filename(self) -> tuple[str, ...]:
+        curr_date = datetime.now().strftime("%m-%d-%Y_%H%M%S")
+        base_filename_uuid = str(uuid.uuid4())[:8]
+        self.arrs_filename = tuple(
+            (
+                self._resources_folder + "/" + base_filename_uuid + "_" +
+                str(self.lat) + "_" + str(self.lon) + "_" +
+                curr_date + "_" + str(i+1) + ".arr"
+            )
+            for i in range(len(self.scene_ids))
+        )
+
+        return self.arrs_filename
+
+    def load_cached_files(self) -> list[bool]:
+        """
+        Looking up every scene in the scene cache before asking GEE for a download URL
+        """
+        self.cache_keys = [
+            SceneCache.make_key(scene_id, self.aoi_coords, self.DIMENSIONS, self.download_format, self.BANDS)
+            for scene_id in self.scene_ids
+        ]
+        self.raw_arrs = [None] * len(self.cache_keys)
+        if self._scene_cache is None:
+            self.is_cached = [False] * len(self.cache_keys)
+            return self.is_cached
+
+        if self._save_arrs:
+            self.is_cached = [
+                self._scene_cache.get(cache_key, arr_filename)
+                for cache_key, arr_filename in zip(self.cache_keys, self.arrs_filename)
+            ]
+        else:
+            self.raw_arrs = [self._scene_cache.load(cache_key) for cache_key in self.cache_keys]
+            self.is_cached = [raw_arr is not None for raw_arr in self.raw_arrs]
+        self._scene_cache.log_stats()
+
+        return self.is_cached
+
+    def __gee_request_to_save(
+        self, s: requests.sessions.Session, url: str, filename: str, position: int = 0
+    ) -> bool:
+        logging.info(f"Requesting image at {url}...")
         try:
             r = s.get(url, stream=True, timeout=10)
         except requests.exceptions.ConnectionError:
             logging.error("Failed to download the image")
-            return
+            return False
+        if not r.ok:
+            logging.error(f"Failed to download the image (HTTP {r.status_code})")
+            return False
 
         total = int(r.headers.get('content-length', 0))
 
         logging.info(f"Saving raw request content to {filename}")
         with open(filename, "wb") as f, tqdm(
             total=total,
+            desc=os.path.basename(filename),
+            position=position,
             unit="iB",
             unit_scale=True,
             unit_divisor=1024,
         ) as bar:
-            for data in r.iter_content(chunk_size=1024):
+            for data in r.iter_content(chunk_size=self.DOWNLOAD_CHUNK_SIZE):
                 size = f.write(data)
                 bar.update(size)
 
-    def download_files(self) -> tuple[str, str]:
+        return True
+
+    def __gee_request_to_array(
+        self,
+        s: requests.sessions.Session,
+        url: str,
+        name: str,
+        position: int = 0,
+        download_format: str = None,
+    ) -> np.ndarray:
         """
-        Downloading and saving the 2 images as numpy arrays
+        Streams a .npy response straight into a preallocated numpy array, nothing touches the disk
+        The header in the first bytes gives the shape and dtype of the array to allocate
+        Other formats (GeoTIFF) are compressed, their raw bytes are kept as a uint8 array
         """
-        curr_date = datetime.now().strftime("%m-%d-%Y_%H%M%S")
-        base_filename_uuid = str(uuid.uuid4())[:8]
-        self.arrs_filename = (
-            (
-                self._resources_folder + "/" + base_filename_uuid + "_" +
-                str(self.lat) + "_" + str(self.lon) + "_" +
-                curr_date + "_" + "1" + ".arr"
-            ),
-            (
-                self._resources_folder + "/" + base_filename_uuid + "_" +
-                str(self.lat) + "_" + str(self.lon) + "_" +
-                curr_date + "_" + "2" + ".arr"
-            )
-        )
+        logging.info(f"Requesting image at {url}...")
+        try:
+            r = s.get(url, stream=True, timeout=10)
+        except requests.exceptions.ConnectionError:
+            logging.error("Failed to download the image")
+            return None
+        if not r.ok:
+            logging.error(f"Failed to download the image (HTTP {r.status_code})")
+            return None
+
+        total = int(r.headers.get('content-length', 0))
+
+        logging.info(f"Streaming raw request content into memory for {name}")
+        arr = None
+        header = b""
+        with tqdm(
+            total=total,
+            desc=os.path.basename(name),
+            position=position,
+            unit="iB",
+            unit_scale=True,
+            unit_divisor=1024,
+        ) as bar:
+            if self.DOWNLOAD_FORMATS[download_format or self.download_format] != "npy":
+                content = bytearray()
+                for data in r.iter_content(chunk_size=self.DOWNLOAD_CHUNK_SIZE):
+                    bar.update(len(data))
+                    content += data
+                return np.frombuffer(content, dtype=np.uint8)
+
+            for data in r.iter_content(chunk_size=self.DOWNLOAD_CHUNK_SIZE):
+                bar.update(len(data))
+                if arr is None:
+                    header += data
+                    parsed_header = _parse_npy_header(header)
+                    if parsed_header is None:
+                        continue
+                    shape, fortran_order, dtype, data_offset = parsed_header
+                    arr = np.empty(shape, dtype=dtype, order="F" if fortran_order else "C")
+                    # flat byte view of the array, chunks are copied into it as they arrive
+                    arr_bytes = (arr.T if fortran_order else arr).reshape(-1).view(np.uint8)
+                    offset = 0
+                    data = header[data_offset:]
+                    header = None
+
+                arr_bytes[offset:offset+len(data)] = np.frombuffer(data, dtype=np.uint8)
+                offset += len(data)
 
+        if arr is None or offset != arr_bytes.size:
+            logging.error(f"Failed to download the image (truncated .npy payload for {name})")
+            return None
+
+        return arr
+
+    def _make_download_session(self, pool_size: int) -> requests.Session:
         s = requests.Session()
         retries = Retry(
             total=5,
             backoff_factor=0.1
         )
-        s.mount('https://', HTTPAdapter(max_retries=retries))
+        s.mount('https://', self._transport.make_adapter(pool_maxsize=pool_size, max_retries=retries))
+        return s
+
+    def download_files(self) -> tuple[str, ...]:
+        """
+        Downloading and saving the images as numpy arrays, or keeping them in memory only
+        All the transfers run at the same time on a shared pool of connections
+        Successful downloads are added to the scene cache, a failed one raises a ValueError
+        """
+        to_download = [
+            (i, img_url, img_filepath, cache_key)
+            for i, (img_url, img_filepath, cache_key)
+            in enumerate(zip(self.imgs_url, self.arrs_filename, self.cache_keys))
+            if img_url is not None
+        ]
+        if not to_download:
+            return self.arrs_filename
+
+        # one connection per image so that no transfer waits for another one
+        s = self._make_download_session(len(to_download))
 
-        for img_url, img_filepath in zip(self.imgs_url, self.arrs_filename):
-            logging.info(f"Requesting image at {img_url}...")
-            self.__gee_request_to_save(s, img_url, img_filepath)
+        request_to = self.__gee_request_to_save if self._save_arrs else self.__gee_request_to_array
+        with ThreadPoolExecutor(max_workers=len(to_download)) as executor:
+            downloads = [
+                (
+                    i,
+                    executor.submit(request_to, s, img_url, img_filepath, i),
+                    img_filepath,
+                    cache_key,
+                )
+                for i, img_url, img_filepath, cache_key in to_download
+            ]
+            failed = []
+            for i, download, img_filepath, cache_key in downloads:
+                if not self._save_arrs:
+                    self.raw_arrs[i] = download.result()
+                    if self.raw_arrs[i] is None:
+                        failed.append(self.scene_ids[i])
+                    elif self._scene_cache is None:
+                        continue
+                    elif self.DOWNLOAD_FORMATS[self.download_format] == "npy":
+                        self._scene_cache.put_array(cache_key, self.raw_arrs[i])
+                    else:
+                        self._scene_cache.put_bytes(cache_key, self.raw_arrs[i].tobytes())
+                elif not download.result():
+                    failed.append(self.scene_ids[i])
+                elif self._scene_cache is not None:
+                    self._scene_cache.put(cache_key, img_filepath)
+        s.close()
+
+        if failed:
+            raise ValueError(f"Could not download scene(s) {', '.join(failed)}")
 
         return self.arrs_filename
 
-    def _get_index(self, avg_metric, scale):
-        for i, threshold in enumerate(scale):
-            if avg_metric < threshold:
-                return i
-        return len(scale)
+    def _download_tile(
+        self,
+        s: requests.sessions.Session,
+        scene_id: str,
+        tile: Tile,
+        mosaic: np.ndarray,
+        name: str,
+        position: int,
+        mask_mosaic: np.ndarray = None,
+    ) -> None:
+        cache_key = SceneCache.make_key(
+            scene_id, tile.crs_transform, f"{tile.cols}x{tile.rows}", self.download_format, self.BANDS
+        )
+        raw_tile = self._scene_cache.load(cache_key) if self._scene_cache is not None else None
+
+        if raw_tile is None:
+            raw_tile = self.__gee_request_to_array(
+                s, self._get_img_download_url(scene_id, tile=tile), name, position
+            )
+            if raw_tile is None:
+                raise ValueError(f"Could not download tile {tile.row},{tile.col} of scene {scene_id}")
+            if self._scene_cache is not None:
+                if self.DOWNLOAD_FORMATS[self.download_format] == "npy":
+                    self._scene_cache.put_array(cache_key, raw_tile)
+                else:
+                    self._scene_cache.put_bytes(cache_key, raw_tile.tobytes())
+
+        mosaic[tile.row:tile.row+tile.rows, tile.col:tile.col+tile.cols] = to_uint8_rgb(
+            raw_tile, self.download_format
+        )
+        if mask_mosaic is not None:
+            mask_mosaic[tile.row:tile.row+tile.rows, tile.col:tile.col+tile.cols] = clear_mask(
+                self._load_bands(s, scene_id, (QA_BAND,), position, tile)
+            )
 
-    def compute_risk(self) -> float:
+    def download_mosaics(self) -> tuple[str, ...]:
         """
-        Compute individual indexes and the final risk index from all the data collected
+        Downloading regions larger than a single GEE request, tile by tile
+        Tiles are normalized to uint8 as they arrive and written into a memory-mapped mosaic (.arr file),
+        so peak memory depends on the tile size and the number of workers, not on the region size
+        With a cloud mask, the QA band of every tile is turned into a memory-mapped mask mosaic the same way
         """
-        self.indicators['dryness'] = []
-        for color1, color2 in zip(self.imgs[0].p_and_c, self.imgs[1].p_and_c):
-            r1, r2 = color1['rgb'][0].item(), color2['rgb'][0].item()
-            g1, g2 = color1['rgb'][1].item(), color2['rgb'][1].item()
-            _dryness = (1 + (r1 - r2) / r2) * (1 + (g2 - g1) / g1)
-            self.indicators['dryness'].append(_dryness)
+        tiler = AoiTiler(*self.aoi_bounds, self.scale, self._tile_size)
+        tiles = tiler.tiles()
+        logging.info(f"Downloading {len(tiles)} tile(s) per image for {tiler.shape[0]}x{tiler.shape[1]} px mosaics")
 
-        _avg_wind = sum(self.weather_data.wind) / len(self.weather_data.wind)
-        _beaufort_scale = [0.5, 1.5, 3.3, 5.5, 7.9, 10.7, 13.8, 17.1, 20.7, 24.4, 28.4, 32.6]
-        self.indicators['wind'] = (self._get_index(_avg_wind, _beaufort_scale) + 1) / len(_beaufort_scale)
+        self.raw_arrs = [
+            np.lib.format.open_memmap(arr_filename, mode="w+", dtype=np.uint8, shape=(*tiler.shape, 3))
+            for arr_filename in self.arrs_filename
+        ]
+        if self.cloud_mask:
+            self.masks = [
+                np.lib.format.open_memmap(
+                    arr_filename[:-len(".arr")] + "_mask.arr", mode="w+", dtype=np.bool_, shape=tiler.shape
+                )
+                for arr_filename in self.arrs_filename
+            ]
 
-        self.indicators['humidity'] = sum(self.weather_data.humidity) / len(self.weather_data.humidity)
-        self.indicators['humidity'] = 1 - self.indicators['humidity'] / 100
+        s = self._make_download_session(self._tile_workers)
+        with ThreadPoolExecutor(max_workers=self._tile_workers) as executor:
+            downloads = [
+                executor.submit(
+                    self._download_tile,
+                    s,
+                    scene_id,
+                    tile,
+                    mosaic,
+                    f"{arr_filename} (tile {j+1}/{len(tiles)})",
+                    (i * len(tiles) + j) % self._tile_workers,
+                    mask_mosaic,
+                )
+                for i, (scene_id, arr_filename, mosaic, mask_mosaic)
+                in enumerate(zip(self.scene_ids, self.arrs_filename, self.raw_arrs, self.masks))
+                for j, tile in enumerate(tiles)
+            ]
+            for download in downloads:
+                download.result()
+        s.close()
 
-        _avg_rain = sum(self.weather_data.rain) / len(self.weather_data.rain)
-        _rainfall_classification = [10, 35.5, 64.4, 124.4]
-        self.indicators['rain'] = 1 - self._get_index(_avg_rain, _rainfall_classification) / len(_rainfall_classification)
+        for mosaic in self.raw_arrs + self.masks:
+            if mosaic is not None:
+                mosaic.flush()
+        if self._scene_cache is not None:
+            self._scene_cache.log_stats()
 
-        _avg_temp = sum(self.weather_data.temperature) / len(self.weather_data.temperature)
-        _temp_classification = [4.1, 8.0, 13.0, 18.0, 23.0, 29.0, 35.0, 41.0]
-        self.indicators['temp'] = (self._get_index(_avg_temp, _temp_classification) + 1) / len(_temp_classification)
+        return self.arrs_filename
 
-        self.indicators['sunlight'] = sum(self.weather_data.sunlight) / len(self.weather_data.sunlight)
-        self.indicators['sunlight'] /= 11
+    def _load_bands(
+        self, s: requests.sessions.Session, scene_id: str, bands: tuple, position: int = 0, tile: Tile = None
+    ) -> np.ndarray:
+        """
+        Raw digital numbers of extra bands of a scene (spectral or QA bands), on the grid of the AoI
+        at the fixed DIMENSIONS or on the grid of a tile, looked up in the scene cache first
+        """
+        if tile is None:
+            grid_key = [self.aoi_coords, self.DIMENSIONS]
+            name = f"{scene_id} ({', '.join(bands)})"
+        else:
+            grid_key = [tile.crs_transform, f"{tile.cols}x{tile.rows}"]
+            name = f"{scene_id} ({', '.join(bands)}, tile {tile.row},{tile.col})"
+        cache_key = SceneCache.make_key(scene_id, *grid_key, "dn", bands)
+        raw_arr = self._scene_cache.load(cache_key) if self._scene_cache is not None else None
+        if raw_arr is None:
+            raw_arr = self.__gee_request_to_array(
+                s,
+                self._get_img_download_url(scene_id, "dn", tile, bands),
+                name,
+                position,
+                download_format="dn",
+            )
+            if raw_arr is None:
+                raise ValueError(f"Could not download the {', '.join(bands)} band(s) of scene {scene_id}")
+            if self._scene_cache is not None:
+                self._scene_cache.put_array(cache_key, raw_arr)
+        return raw_arr
 
-        logging.info(self.indicators)
+    def download_masks(self) -> list[np.ndarray]:
+        """
+        Downloading the QA band of both scenes on the grid of the images, and keeping the mask of their
+        clear pixels (see cloud_mask.clear_mask)
+        """
+        s = self._make_download_session(self.NB_IMGS)
+        with ThreadPoolExecutor(max_workers=self.NB_IMGS) as executor:
+            qa_arrs = executor.map(
+                self._load_bands,
+                [s] * self.NB_IMGS,
+                self.scene_ids,
+                [(QA_BAND,)] * self.NB_IMGS,
+                range(self.NB_IMGS),
+            )
+            self.masks = [clear_mask(qa_arr) for qa_arr in qa_arrs]
+        s.close()
+
+        for scene_id, mask in zip(self.scene_ids, self.masks):
+            logging.info(f"{mask.mean():.1%} of the pixels of scene {scene_id} are clear")
+
+        return self.masks
+
+    def compute_spectral_change(self) -> SpectralChange:
+        """
+        Downloading the red, NIR and SWIR bands of both scenes (raw digital numbers, whole AoI at the fixed
+        DIMENSIONS whatever the scale) and computing the per-pixel change of their spectral indices
+        With a cloud mask, the masks of the images are reused (resampled on the grid of the bands for
+        mosaics) and their masked pixels are left out
+        The bands are only kept in memory, the change rasters replace them
+        """
+        s = self._make_download_session(self.NB_IMGS)
+        with ThreadPoolExecutor(max_workers=self.NB_IMGS) as executor:
+            raw_arrs = list(executor.map(
+                self._load_bands,
+                [s] * self.NB_IMGS,
+                self.scene_ids,
+                [SPECTRAL_BANDS] * self.NB_IMGS,
+                range(self.NB_IMGS),
+            ))
+        s.close()
+        masks = [
+            align(raw_arr, mask.view(np.uint8), cv2.INTER_NEAREST).view(np.bool_) if mask is not None else None
+            for raw_arr, mask in zip(raw_arrs, self.masks)
+        ]
+
+        # scenes are sorted from the most recent one
+        self.spectral_change = SpectralChange(*raw_arrs, recent_mask=masks[0], oldest_mask=masks[1])
+        if not self.spectral_change.stats['valid']:
+            raise ValueError("The spectral bands of the scenes have no valid pixel in common")
+        logging.info(f"Spectral change: {self.spectral_change.stats}")
+
+        return self.spectral_change
+
+    def compute_change_map(self) -> ChangeMap:
+        """
+        Per-pixel dryness change between both images, at full resolution
+        """
+        # scenes are sorted from the most recent one
+        self.change_map = ChangeMap(
+            self.imgs[0].np_arr, self.imgs[1].np_arr, recent_mask=self.masks[0], oldest_mask=self.masks[1]
+        )
+        if not self.change_map.stats['valid']:
+            raise ValueError("The images have no valid pixel in common")
+
+        return self.change_map
+
+    def make_change_overlay(self) -> Resource:
+        """
+        Change map drawn over the most recent image, for the report
+        """
+        curr_date = datetime.now().strftime("%m-%d-%Y_%H%M%S")
+        return self.change_map.make_overlay(
+            self.imgs[0].np_arr,
+            f"{self._resources_folder}/dryness_change_{curr_date}.png",
+            self._in_memory,
+        )
+
+    def verify_download_format(self) -> float:
+        """
+        Downloads the first scene again in the legacy float format and compares both uint8 images
+        Returns the share of pixel values that differ (the compact formats should give 0)
+        """
+        with self._make_download_session(1) as s:
+            reference = self.__gee_request_to_array(
+                s,
+                self._get_img_download_url(self.scene_ids[0], "float"),
+                self.arrs_filename[0] + " (float reference)",
+                download_format="float",
+            )
+        if reference is None:
+            logging.error("Could not download the reference scene to verify the download format")
+            return None
+
+        reference = to_uint8_rgb(reference, "float")
+        diff = np.abs(reference.astype('int16') - self.imgs[0].np_arr.astype('int16'))
+        mismatch = np.count_nonzero(diff) / diff.size
+        logging.info(
+            f"Download format '{self.download_format}' vs 'float': {mismatch:.4%} of values differ, "
+            f"max difference {diff.max()}"
+        )
+
+        return mismatch
 
-        self.overall_risk = (
-            math.prod(self.indicators['dryness'])
-            * self.indicators['wind']
-            * self.indicators['humidity']
-            * self.indicators['rain']
-            * self.indicators['temp']
-            * self.indicators['sunlight']
+    def compute_risk(self, model: RiskModel = None) -> float:
+        """
+        Compute individual indexes and the final risk index from all the data collected
+        """
+        model = model if model is not None else RiskModel()
+        dryness = None
+        if self.spectral_change is not None:
+            dryness = model.spectral_dryness(
+                [self.spectral_change.stats['d_ndvi']], [self.spectral_change.stats['d_nbr']]
+            )
+        elif self.change_map is not None:
+            dryness = [[self.change_map.stats['dryness']]]
+        risk, indicators = model.score(
+            [[color['rgb'] for color in self.imgs[0].p_and_c]],
+            [[color['rgb'] for color in self.imgs[1].p_and_c]],
+            model.aggregate(self.weather_data.forecast[np.newaxis]),
+            dryness,
         )
+        for name, value in indicators.items():
+            self.indicators[name] = value[0].tolist()
+
+        logging.info(self.indicators)
+
+        self.overall_risk = risk[0].item()
         logging.info("Final risk: " + str(self.overall_risk))
 
         return self.overall_risk
 
 
+class WeatherClient():
+    """
+    HTTP client of the OpenWeatherMap API, meant to be shared by all the WeatherData of a run
+    Connections are pooled and kept alive, every request is bounded by a timeout and retried
+    with an exponential backoff, and at most max_concurrency requests run at the same time
+    The session stays open until close (or the end of a with block)
+    """
+    WEATHER_URL = "https://api.openweathermap.org/data/2.5/onecall"
+
+    def __init__(
+        self,
+        api_key: str,
+        transport: LiveTransport = None,
+        max_concurrency: int = 8,
+        timeout: float = 10,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+    ) -> None:
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+        self.session = requests.Session()
+        retries = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+        )
+        transport = transport if transport is not None else LiveTransport()
+        self.session.mount(
+            'https://',
+            transport.make_adapter(pool_maxsize=max_concurrency, max_retries=retries),
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"WeatherClient(max_concurrency={self.max_concurrency}, timeout={self.timeout}, "
+            f"api_key={'*'*(len(self.api_key)-8) + self.api_key[-8:]})"
+        )
+
+    def fetch(self, lat: float, lon: float) -> dict:
+        """
+        Daily forecast of one location, as returned by the onecall endpoint
+        An error status (e.g. 401 for a wrong API key) raises a requests.HTTPError
+        """
+        parameters = {
+            'lat': lat,
+            'lon': lon,
+            'exclude': "current,minutely,hourly",
+            'appid': self.api_key,
+            'units': "metric"
+        }
+        with self._semaphore:
+            r = self.session.get(self.WEATHER_URL, params=parameters, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def __enter__(self) -> "WeatherClient":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+
 class WeatherData():
-    def __init__(self, lat: float, lon: float, api_key: str, resources_folder: str) -> None:
+    def __init__(
+        self,
+        lat: float,
+        lon: float,
+        api_key: str,
+        resources_folder: str,
+        in_memory: bool = False,
+        transport: LiveTransport = None,
+        cache: WeatherCache = None,
+        client: WeatherClient = None,
+        store: WeatherStore = None,
+    ) -> None:
         self.lat = lat
         self.lon = lon
         self.api_key = api_key
         self._resources_folder = resources_folder
+        self._in_memory = in_memory
+        self._cache = cache
+        self._store = store
+        self._transport = transport
+        self._client = client
         self.get_and_set_data_from_api()
 
     def __repr__(self) -> str:
@@ -261,43 +942,83 @@ class WeatherData():
 
     def get_and_set_data_from_api(self) -> None:
         """
-        Query the weather API and structure the useful data
+        Query the weather API (unless a recent forecast of the same grid cell is cached,
+        or of the same site is in the weather store) and structure the useful data
+        Without a shared client, a client is opened for this request only and closed right after
         """
-        weather_url = "https://api.openweathermap.org/data/2.5/onecall"
-        parameters = {
-            'lat': self.lat,
-            'lon': self.lon,
-            'exclude': "current,minutely,hourly",
-            'appid': self.api_key,
-            'units': "metric"
-        }
-        r = requests.get(weather_url, params=parameters)
-        req_data = r.json()
-
-        self.dates = [datetime.fromtimestamp(day['dt']) for day in req_data['daily']]
-        self.temperature = [day['temp']['day'] for day in req_data['daily']]
-        self.humidity = [day['humidity'] for day in req_data['daily']]
-        self.wind = [day['wind_speed'] for day in req_data['daily']]
-        self.rain = [day.get('rain', 0) for day in req_data['daily']]
-        self.rain_p = [day['pop'] for day in req_data['daily']]
-        self.sunlight = [day['uvi'] for day in req_data['daily']]
-
-    def make_temperature_chart(self) -> str:
+        req_data = self._cache.get(self.lat, self.lon) if self._cache is not None else None
+        stored = (
+            self._store.latest(self.lat, self.lon)
+            if req_data is None and self._store is not None
+            else None
+        )
+        if req_data is not None:
+            self.forecast = forecast_to_array(req_data)
+        elif stored is not None:
+            self.forecast = stored
+        else:
+            if self._client is not None:
+                req_data = self._client.fetch(self.lat, self.lon)
+            else:
+                with WeatherClient(self.api_key, self._transport) as client:
+                    req_data = client.fetch(self.lat, self.lon)
+            self.forecast = forecast_to_array(req_data)
+            if self._cache is not None:
+                self._cache.put(self.lat, self.lon, req_data)
+            if self._store is not None:
+                self._store.append(self.lat, self.lon, self.forecast)
+
+        if self._cache is not None:
+            self._cache.log_stats()
+        if self._store is not None:
+            self._store.log_stats()
+
+    @property
+    def dates(self) -> list[datetime]:
+        return [datetime.fromtimestamp(dt) for dt in self.forecast['dt'].tolist()]
+
+    @property
+    def temperature(self) -> np.ndarray:
+        return self.forecast['temperature']
+
+    @property
+    def humidity(self) -> np.ndarray:
+        return self.forecast['humidity']
+
+    @property
+    def wind(self) -> np.ndarray:
+        return self.forecast['wind']
+
+    @property
+    def rain(self) -> np.ndarray:
+        return self.forecast['rain']
+
+    @property
+    def rain_p(self) -> np.ndarray:
+        return self.forecast['rain_p']
+
+    @property
+    def sunlight(self) -> np.ndarray:
+        return self.forecast['sunlight']
+
+    def make_temperature_chart(self) -> Resource:
         curr_date = datetime.now().strftime("%m-%d-%Y_%H%M%S")
         graph_filename = f"{self._resources_folder}/temperature_chart_{curr_date}.svg"
         day_labels = [dt.strftime("%m/%d") for dt in self.dates]
 
+        # the title and ticks are sized for a large figure
+        plt.figure(figsize=(18, 9))
         plt.bar(day_labels, self.temperature, color="firebrick")
         plt.title("Temperature Forecast", fontsize=50)
         plt.ylabel("°C", fontsize='xx-large')
         plt.xticks(fontsize='xx-large')
         plt.yticks(fontsize='xx-large')
-        plt.savefig(graph_filename)
-        plt.clf()
+        graph = save_figure(graph_filename, self._in_memory)
+        plt.close()
 
-        return graph_filename
+        return graph
 
-    def make_humidity_rain_chart(self) -> str:
+    def make_humidity_rain_chart(self) -> Resource:
         curr_date = datetime.now().strftime("%m-%d-%Y_%H%M%S")
         graph_filename = f"{self._resources_folder}/hum_rain_chart_{curr_date}.svg"
         day_labels = [dt.strftime("%m/%d") for dt in self.dates]
@@ -316,34 +1037,36 @@ class WeatherData():
         ax.legend(legends, labs, loc=0)
 
         plt.title("Rain and Humidity Forecast", fontsize=20)
-        fig.savefig(graph_filename)
-        plt.clf()
+        graph = save_figure(graph_filename, self._in_memory)
+        plt.close()
 
-        return graph_filename
+        return graph
 
-    def make_wind_chart(self) -> str:
+    def make_wind_chart(self) -> Resource:
         curr_date = datetime.now().strftime("%m-%d-%Y_%H%M%S")
         graph_filename = f"{self._resources_folder}/wind_chart_{curr_date}.svg"
         day_labels = [dt.strftime("%m/%d") for dt in self.dates]
 
+        plt.figure()
         plt.plot(day_labels, self.wind, marker='o', color="olivedrab")
         plt.title("Wind forecast", fontsize=20)
         plt.ylabel("m/s")
-        plt.savefig(graph_filename)
-        plt.clf()
+        graph = save_figure(graph_filename, self._in_memory)
+        plt.close()
 
-        return graph_filename
+        return graph
 
-    def make_sunlight_chart(self) -> str:
+    def make_sunlight_chart(self) -> Resource:
         curr_date = datetime.now().strftime("%m-%d-%Y_%H%M%S")
         graph_filename = f"{self._resources_folder}/sunlight_chart_{curr_date}.svg"
         day_labels = [dt.strftime("%m/%d") for dt in self.dates]
 
+        plt.figure()
         plt.bar(day_labels, self.sunlight, color="gold")
         plt.title("Sunlight forecast", fontsize=20)
         plt.ylabel("UV index")
         plt.ylim(top=10)
-        plt.savefig(graph_filename)
-        plt.clf()
+        graph = save_figure(graph_filename, self._in_memory)
+        plt.close()
 
-        return graph_filename
+        return graph
@@ -4,6 +4,8 @@ import os
 
 import jinja2
 
+from resources import Resource, read_resource
+
 
 class FinalReport():
     def __init__(
@@ -29,15 +31,14 @@ class FinalReport():
         """
         Load resources to the class to pass them to the Jinja template
         """
-        for resource_name, resource_path in resources.items():
-            self._resources[resource_name] = self._image_file_path_to_base64_string(resource_path)
+        for resource_name, resource in resources.items():
+            self._resources[resource_name] = self._image_file_path_to_base64_string(resource)
 
-    def _image_file_path_to_base64_string(self, filepath: str) -> str:
+    def _image_file_path_to_base64_string(self, resource: Resource) -> str:
         """
-        Encode images to base64 to ensure data integrity
+        Encode images (files or in-memory buffers) to base64 to ensure data integrity
         """
-        with open(filepath, 'rb') as f:
-            return base64.b64encode(f.read()).decode()
+        return base64.b64encode(read_resource(resource)).decode()
 
     def _load_template(self) -> None:
         templateLoader = jinja2.FileSystemLoader(searchpath="./")
@@ -1,21 +1,297 @@
 import logging
 from datetime import datetime
+from statistics import NormalDist
 
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
 from PIL import Image
-from sklearn.cluster import KMeans
+
+from clustering import ClusteringBackend, SklearnBackend, StreamingKMeans
+from resources import Resource, save_figure, save_image
+
+
+def decode_geotiff(content: np.ndarray) -> np.ndarray:
+    """
+    Decodes the bytes of a 3-band uint8 GeoTIFF into an RGB array
+    """
+    img = cv2.imdecode(content, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError("Could not decode the GeoTIFF scene")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB) # OpenCV orders the channels as BGR
+
+
+def read_scene(filename: str) -> np.ndarray:
+    """
+    Reads a scene as downloaded from GEE: .npy payloads are memory-mapped (read-only, pages are
+    only loaded when the array is converted), any other format is returned as its raw bytes (uint8 array)
+    """
+    with open(filename, "rb") as f:
+        is_npy = f.read(6) == b"\x93NUMPY"
+    if is_npy:
+        return np.load(filename, mmap_mode="r")
+    return np.fromfile(filename, dtype=np.uint8)
+
+
+def bands_to_channels(raw_arr: np.ndarray) -> np.ndarray:
+    """
+    Turns a structured array with one field per band into a (..., n_bands) array
+    When all the bands share the same dtype (always the case with GEE), this is a view, no copy
+    """
+    if not raw_arr.dtype.names:
+        return raw_arr
+    return structured_to_unstructured(raw_arr)
+
+
+def to_uint8_rgb(raw_arr: np.ndarray, arr_format: str, chunk_rows: int = 128) -> np.ndarray:
+    """
+    Transforms data with max/min according to the dataset rules, whatever the transfer format:
+    float: scaled reflectance, clipped to [0, 0.3] and stretched to [0, 255]
+    dn: raw digital numbers, the Landsat scale factors are applied first
+    uint8/geotiff: already clipped and stretched by GEE
+    float and dn scenes are converted chunk_rows rows at a time, in place in a small buffer,
+    so that no full-size temporary is ever allocated besides the uint8 output
+    """
+    if arr_format == "geotiff" and raw_arr.ndim == 1:
+        return decode_geotiff(raw_arr)
+    arr = bands_to_channels(raw_arr)
+    if arr_format not in ("float", "dn"):
+        # no copy when the scene is already a contiguous uint8 array (e.g. a memory-mapped mosaic)
+        return np.ascontiguousarray(arr, dtype='uint8')
+
+    out = np.empty(arr.shape, dtype='uint8')
+    buffer = np.empty((min(chunk_rows, len(arr)), *arr.shape[1:]), dtype='float64')
+    for start in range(0, len(arr), chunk_rows):
+        chunk = buffer[:len(arr) - start] if start + chunk_rows > len(arr) else buffer
+        np.copyto(chunk, arr[start:start+len(chunk)], casting='unsafe')
+        if arr_format == "dn":
+            np.multiply(chunk, 0.0000275, out=chunk)
+            np.subtract(chunk, 0.2, out=chunk)
+        np.clip(chunk, 0, 0.3, out=chunk)
+        # same operations, in the same order, as 255 * (arr / 0.3)
+        np.divide(chunk, 0.3, out=chunk)
+        np.multiply(chunk, 255, out=chunk)
+        np.copyto(out[start:start+len(chunk)], chunk, casting='unsafe')
+
+    return out
+
+
+def color_codes(pixels: np.ndarray, bits: int) -> np.ndarray:
+    """
+    Index of the quantized color of uint8 RGB pixels (n, 3) in a 3D grid of 2**bits cells per channel
+    """
+    shift = 8 - bits
+    codes = np.empty(len(pixels), dtype=np.uint32)
+    np.right_shift(pixels[:, 0], shift, out=codes, casting='unsafe')
+    for channel in (1, 2):
+        np.left_shift(codes, bits, out=codes)
+        np.bitwise_or(codes, pixels[:, channel] >> shift, out=codes)
+    return codes
+
+
+def color_histogram(
+    pixels: np.ndarray, bits: int = 6, mask: np.ndarray = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Bins uint8 RGB pixels (n, 3) into a 3D color histogram with 2**bits bins per channel
+    Returns the mean color of every occupied bin (m, 3) and its number of pixels (m,)
+    With 8 bits, every distinct color has its own bin
+    With a mask (n,), the pixels where it is False are counted in an extra bin, dropped at the end
+    """
+    codes = color_codes(pixels, bits)
+    masked_bin = 1 << (3 * bits)
+    if mask is not None:
+        codes[~mask] = masked_bin
+    if 3 * bits <= 21: # up to 2M bins, counting is cheaper than sorting
+        counts = np.bincount(codes, minlength=masked_bin)
+        occupied = np.flatnonzero(counts[:masked_bin])
+        sums = np.stack([
+            np.bincount(codes, weights=pixels[:, channel], minlength=len(counts))[occupied]
+            for channel in range(3)
+        ], axis=1)
+        counts = counts[occupied]
+    else:
+        unique_codes, inverse, counts = np.unique(codes, return_inverse=True, return_counts=True)
+        sums = np.stack([
+            np.bincount(inverse, weights=pixels[:, channel], minlength=len(counts))
+            for channel in range(3)
+        ], axis=1)
+        if unique_codes[-1] == masked_bin:
+            sums, counts = sums[:-1], counts[:-1]
+
+    return sums / counts[:, np.newaxis], counts
+
+
+def nearest_centers(pixels: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """
+    Index of the nearest center of every pixel (n, 3), computed exactly
+    """
+    centers = np.asarray(centers, dtype="float64")
+    dist = (centers ** 2).sum(axis=1) - 2 * pixels.astype("float64") @ centers.T
+    return dist.argmin(axis=1).astype("uint8")
+
+
+# lookup table value of the cells that contain colors with different nearest centers
+AMBIGUOUS_CELL = 255
+# label raster value of the pixels left out of the analysis by the mask of the image
+MASKED_LABEL = 255
+# longest side (px) of the images drawn in the reports, larger scenes (e.g. tiled mosaics) are downscaled
+REPORT_MAX_SIDE = 1000
+
+
+def nearest_center_lut(centers: np.ndarray, bits: int = 6) -> np.ndarray:
+    """
+    Lookup table giving the nearest center of every cell of quantized RGB colors (indexed by color_codes)
+    A cell gets the nearest center of its middle color when all of its colors share it, AMBIGUOUS_CELL
+    when a decision boundary may cross it (those colors are assigned with nearest_centers)
+    """
+    shift = 8 - bits
+    half_width = ((1 << shift) - 1) / 2
+    levels = np.arange(1 << bits) * (1 << shift) + half_width
+    centers = np.asarray(centers, dtype="float64")
+    # squared distances are separable, one (levels, centers) table per channel
+    dist_r, dist_g, dist_b = ((levels[:, np.newaxis] - centers[:, channel]) ** 2 for channel in range(3))
+    dist_gb = dist_g[:, np.newaxis] + dist_b[np.newaxis]
+    # |x - c_j|^2 - |x - c_i|^2 is linear in x, it varies by at most this much within a cell
+    bounds = 2 * half_width * np.abs(centers[:, np.newaxis] - centers[np.newaxis]).sum(axis=2)
+
+    lut = np.empty((1 << bits, 1 << bits, 1 << bits), dtype="uint8")
+    for r, dist in enumerate(dist_r):
+        dist = dist_gb + dist
+        nearest = dist.argmin(axis=2)
+        margins = dist - np.take_along_axis(dist, nearest[..., np.newaxis], axis=2)
+        ambiguous = (margins <= bounds[nearest]).sum(axis=2) > 1 # the nearest center always counts once
+        lut[r] = np.where(ambiguous, AMBIGUOUS_CELL, nearest)
+    return lut.reshape(-1)
+
+
+def assign_colors(
+    pixels: np.ndarray,
+    centers: np.ndarray,
+    lut: np.ndarray,
+    bits: int = 6,
+    chunk_size: int = 1 << 16,
+    mask: np.ndarray = None,
+) -> np.ndarray:
+    """
+    Index of the nearest center of every uint8 RGB pixel (n, 3), through a lookup table built by
+    nearest_center_lut for these centers, the result is the same as nearest_centers
+    With a mask (n,), the pixels where it is False get MASKED_LABEL instead
+    Pixels are processed chunk_size at a time to keep the temporaries small
+    """
+    labels = np.empty(len(pixels), dtype="uint8")
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start+chunk_size]
+        chunk_labels = labels[start:start+len(chunk)]
+        np.take(lut, color_codes(chunk, bits), out=chunk_labels)
+        ambiguous = chunk_labels == AMBIGUOUS_CELL
+        if mask is not None:
+            chunk_mask = mask[start:start+len(chunk)]
+            ambiguous &= chunk_mask
+        ambiguous = np.flatnonzero(ambiguous)
+        if len(ambiguous):
+            chunk_labels[ambiguous] = nearest_centers(chunk[ambiguous], centers)
+        if mask is not None:
+            chunk_labels[~chunk_mask] = MASKED_LABEL
+    return labels
+
+
+def merge_close_colors(centers: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Group of every center (k, 3): centers within tolerance of each other (Euclidean distance in RGB,
+    directly or through a chain of close centers) share the index of the first of them
+    """
+    centers = np.asarray(centers, dtype="float64")
+    close = np.linalg.norm(centers[:, np.newaxis] - centers[np.newaxis], axis=2) <= tolerance
+    groups = np.arange(len(centers))
+    for _ in range(len(centers)):
+        groups = np.where(close, groups[np.newaxis], len(centers)).min(axis=1)
+    return groups
+
+
+def adaptive_sample_fit(
+    pixels: np.ndarray,
+    clustering: ClusteringBackend,
+    error: float = 0.01,
+    confidence: float = 0.95,
+    max_samples: int = 40000,
+    color_tolerance: float = 16.0,
+    min_samples: int = 1000,
+    random_state: int = 0,
+    mask: np.ndarray = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Clusters random samples of pixels (n, 3), drawn with replacement, until the confidence interval
+    of every color percentage is within +/- error (normal approximation of the binomial
+    distribution), or until max_samples pixels are drawn
+    Clusters whose centers are within color_tolerance of each other count as one color: k-means
+    always finds 3 clusters, on a homogeneous scene they split its noise into arbitrary thirds,
+    whose percentages would need the most pixels to be precise
+    Each round starts from the centers of the previous one and draws as many pixels as the
+    percentages found so far require
+    With a mask (n,), the pixels where it is False are never drawn (draws are rejected until enough are clear)
+    Returns the centers, the percentages and their achieved errors (half-widths of the intervals),
+    the error of merged clusters is the one of their combined percentage
+    """
+    rng = np.random.default_rng(random_state)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    def draw(size: int) -> np.ndarray:
+        indices = rng.integers(0, len(pixels), size)
+        if mask is not None:
+            indices = indices[mask[indices]]
+            while len(indices) < size:
+                more = rng.integers(0, len(pixels), size - len(indices))
+                indices = np.concatenate([indices, more[mask[more]]])
+        return pixels[indices]
+
+    sample = draw(min(min_samples, max_samples))
+    centers = None
+    while True:
+        centers, labels = clustering.fit(sample, init=centers)
+        n_clusters = len(centers)
+        percentages = np.bincount(labels, minlength=n_clusters) / len(sample)
+        groups = merge_close_colors(centers, color_tolerance)
+        color_percentages = np.bincount(groups, weights=percentages, minlength=n_clusters)[groups]
+        errors = z * np.sqrt(color_percentages * (1 - color_percentages) / len(sample))
+        if errors.max() <= error or len(sample) >= max_samples:
+            break
+        required = int(np.ceil(z ** 2 * (color_percentages * (1 - color_percentages)).max() / error ** 2))
+        size = min(max(required, 2 * len(sample)), max_samples) - len(sample)
+        sample = np.concatenate([sample, draw(size)])
+
+    logging.info(
+        f"Adaptive sampling stopped at {len(sample)} pixels, {len(np.unique(groups))} distinct color(s), "
+        f"errors {np.round(errors, 4).tolist()} at {confidence:.0%} confidence"
+    )
+    return centers, percentages, errors
 
 
 class SatelliteImage():
-    def __init__(self, np_arr_filename: str, date: datetime, id: int, resources_folder: str) -> None:
+    def __init__(
+        self,
+        np_arr_filename: str,
+        date: datetime,
+        id: int,
+        resources_folder: str,
+        raw_arr: np.ndarray = None,
+        in_memory: bool = False,
+        arr_format: str = "float",
+        mask: np.ndarray = None,
+    ) -> None:
         self.NB_CLUSTERS = 3
         self.np_arr_filename = np_arr_filename
+        self.arr_format = arr_format
         self.date = date
         self.id = id
         self._resources_folder = resources_folder
-        self.np_arr = self.__to_np_arr()
+        self._in_memory = in_memory
+        self.np_arr = self.__to_np_arr(raw_arr)
+        # True where a pixel is clear (see cloud_mask.clear_mask), only those pixels are analyzed
+        if mask is not None and mask.shape != self.np_arr.shape[:2]:
+            raise ValueError(f"Mask of shape {mask.shape} for an image of shape {self.np_arr.shape}")
+        self.mask = mask
         self.rgb_img = self.__to_rgb_img()
         self.rgb_img_filename = self.np_arr_filename.replace("arr", "png")
         self.rgb_save()
@@ -25,76 +301,232 @@ class SatelliteImage():
         rep['np_arr'] = f"numpy.ndarray({rep['np_arr'].shape})"
         if hasattr(self, 'flat_arr'):
             rep['flat_arr'] = f"numpy.ndarray({rep['flat_arr'].shape})"
+        for key in ('mask', 'flat_mask'):
+            if rep.get(key) is not None:
+                rep[key] = f"numpy.ndarray({rep[key].shape})"
+        if getattr(self, 'label_raster', None) is not None:
+            rep['label_raster'] = f"numpy.ndarray({rep['label_raster'].shape})"
         return (
             f"SatelliteImage({', '.join([key+'='+str(val) for key, val in rep.items()])})"
         )
 
-    def __to_np_arr(self) -> np.ndarray:
+    def __to_np_arr(self, raw_arr: np.ndarray = None) -> np.ndarray:
         """
-        Reads np array from disk and transforms data with max/min according to the dataset rules
+        Reads np array from disk (unless it was downloaded in memory)
+        and transforms data with max/min according to the dataset rules
         """
         logging.info("Creating numpy array from bytes response...")
-        with open(self.np_arr_filename, "rb") as f:
-            arr = np.lib.format.read_array(f)
-        arr = np.array(arr.tolist())
-
-        arr[arr < 0] = 0
-        arr[arr > 0.3] = 0.3
-        arr = (255 * (arr / 0.3)).astype('uint8')
+        if raw_arr is None:
+            raw_arr = read_scene(self.np_arr_filename)
 
-        return arr
+        return to_uint8_rgb(raw_arr, self.arr_format)
 
     def __to_rgb_img(self) -> Image:
-        img = Image.fromarray(self.np_arr, 'RGB')
+        img = Image.fromarray(self.report_arr(), 'RGB')
         return img
 
-    def rgb_save(self) -> None:
-        self.rgb_img.save(self.rgb_img_filename)
-
-    def run_color_analysis(self) -> None:
-        self.prepare()
-        self.p_and_c_analysis()
+    def report_arr(self) -> np.ndarray:
+        """
+        New copy of the image to draw in the reports, downscaled when its longest side is above
+        REPORT_MAX_SIDE, so that a memory-mapped mosaic is never copied at full size
+        """
+        height, width = self.np_arr.shape[:2]
+        ratio = REPORT_MAX_SIDE / max(height, width)
+        if ratio >= 1:
+            return np.array(self.np_arr)
+        size = (max(round(width * ratio), 1), max(round(height * ratio), 1))
+        logging.info(f"Downscaling image {self.id} from {(width, height)} to {size} for the report")
+        return cv2.resize(self.np_arr, size, interpolation=cv2.INTER_AREA)
+
+    def rgb_save(self) -> Resource:
+        self.rgb_img_resource = save_image(self.rgb_img, self.rgb_img_filename, self._in_memory)
+        return self.rgb_img_resource
+
+    def run_color_analysis(
+        self,
+        clustering: ClusteringBackend = None,
+        histogram_bits: int = None,
+        coverage_lut_bits: int = None,
+        label_raster: bool = False,
+        stream_chunk_size: int = None,
+        stream_passes: int = 10,
+        sampling_error: float = None,
+        sampling_confidence: float = 0.95,
+        max_samples: int = 40000,
+        sampling_tolerance: float = 16.0,
+    ) -> None:
+        """
+        With histogram_bits, the colors are clustered from a color histogram of the full
+        resolution image instead of the pixels of the downscaled image
+        With stream_chunk_size, they are clustered from every pixel of the full resolution image,
+        read stream_chunk_size pixels at a time during at most stream_passes passes
+        With sampling_error, they are clustered from random samples of the full resolution image,
+        just large enough for the percentages to be within +/- sampling_error (colors closer than
+        sampling_tolerance counting as one)
+        With coverage_lut_bits, the percentages are measured on every pixel of the full resolution image
+        """
+        self.prepare(
+            full_resolution=(
+                histogram_bits is not None or stream_chunk_size is not None or sampling_error is not None
+            )
+        )
+        self.p_and_c_analysis(
+            clustering,
+            histogram_bits,
+            coverage_lut_bits,
+            label_raster,
+            stream_chunk_size,
+            stream_passes,
+            sampling_error,
+            sampling_confidence,
+            max_samples,
+            sampling_tolerance,
+        )
         self.make_bar_chart()
         self.make_final_output()
 
-    def prepare(self) -> np.ndarray:
+    def prepare(self, full_resolution: bool = False) -> np.ndarray:
         """
         Reduce image size and reshape data to make it analyzable
+        With a mask, masked pixels are dropped: at full resolution flat_arr keeps every pixel (a view,
+        no copy) and flat_mask tells the analysis which ones to skip, chunk by chunk,
+        once downscaled every cell is the mean of its clear pixels and the cells that are mostly
+        masked are left out of flat_arr (flat_mask is then None)
         """
-        tmp_arr = self.np_arr.copy()
-        logging.info(f"Original image shape: {tmp_arr.shape}")
-
-        tmp_arr = cv2.resize(tmp_arr, (200, 200), interpolation=cv2.INTER_AREA)
-        logging.info(f"After resizing image: {tmp_arr.shape}")
+        self.flat_mask = None
+        if full_resolution:
+            self.flat_arr = np.reshape(self.np_arr, (-1, 3))
+            logging.info(f"Full resolution flattened array: {self.flat_arr.shape}")
+            if self.mask is not None:
+                self.flat_mask = np.reshape(self.mask, -1)
+                if not self.flat_mask.any():
+                    raise ValueError(f"Every pixel of image {self.id} is masked")
+            return self.flat_arr
+
+        if self.mask is None:
+            logging.info(f"Original image shape: {self.np_arr.shape}")
+
+            tmp_arr = cv2.resize(self.np_arr, (200, 200), interpolation=cv2.INTER_AREA)
+            logging.info(f"After resizing image: {tmp_arr.shape}")
+
+            self.flat_arr = np.reshape(tmp_arr, (-1, 3))
+        else:
+            logging.info(f"Original image shape: {self.np_arr.shape}")
+            clear = cv2.resize(self.mask.astype("float32"), (200, 200), interpolation=cv2.INTER_AREA)
+            tmp_arr = cv2.resize(
+                np.multiply(self.np_arr, self.mask[..., np.newaxis], dtype="float32"),
+                (200, 200),
+                interpolation=cv2.INTER_AREA,
+            )
+            logging.info(f"After resizing image: {tmp_arr.shape}")
 
-        self.flat_arr = np.reshape(tmp_arr, (-1, 3))
+            kept = clear >= 0.5
+            tmp_arr = np.rint(tmp_arr[kept] / clear[kept, np.newaxis])
+            self.flat_arr = tmp_arr.astype("uint8")
+            if not len(self.flat_arr):
+                raise ValueError(f"Every pixel of image {self.id} is masked")
         logging.info(f"After Flattening array: {self.flat_arr.shape}")
 
         return self.flat_arr
 
-    def p_and_c_analysis(self) -> list[dict]:
+    def p_and_c_analysis(
+        self,
+        clustering: ClusteringBackend = None,
+        histogram_bits: int = None,
+        coverage_lut_bits: int = None,
+        label_raster: bool = False,
+        stream_chunk_size: int = None,
+        stream_passes: int = 10,
+        sampling_error: float = None,
+        sampling_confidence: float = 0.95,
+        max_samples: int = 40000,
+        sampling_tolerance: float = 16.0,
+    ) -> list[dict]:
         """
         Perform a cluster analysis to find the 3 dominant colors in the sat img,
         along with their percentage presence
+        sklearn's KMeans is used unless another clustering backend is given
+        With histogram_bits, the occupied bins of the color histogram are clustered (weighted by
+        their pixel count) and the percentages are exact pixel counts
+        With stream_chunk_size, every pixel is clustered by a StreamingKMeans started from the
+        centers the backend finds on a sample, the percentages are also exact pixel counts
+        With sampling_error, random pixels are clustered (see adaptive_sample_fit) and every
+        entry of p_and_c also gets the 'error' of its percentage at sampling_confidence
+        With coverage_lut_bits, once the colors are found, every pixel of the full resolution image
+        is assigned to its nearest dominant color through a lookup table of quantized colors
+        (see nearest_center_lut), label_raster then keeps the (rows, cols) map of the assignments,
+        numbered in the order of p_and_c (MASKED_LABEL for the pixels left out by the mask)
+        Percentages are shares of the clear pixels only
         """
-        kmeans = KMeans(n_clusters=self.NB_CLUSTERS, random_state=0)
-        kmeans.fit(self.flat_arr)
-
-        percentages = np.unique(kmeans.labels_, return_counts = True)[1] / self.flat_arr.shape[0]
-        dominant_colors = np.array(kmeans.cluster_centers_, dtype="uint")
+        clustering = clustering if clustering is not None else SklearnBackend(self.NB_CLUSTERS)
+        errors = None
+        if sampling_error is not None:
+            centers, percentages, errors = adaptive_sample_fit(
+                self.flat_arr,
+                clustering,
+                sampling_error,
+                sampling_confidence,
+                max_samples,
+                sampling_tolerance,
+                mask=self.flat_mask,
+            )
+        elif stream_chunk_size is not None:
+            centers, counts = StreamingKMeans(clustering, stream_chunk_size, stream_passes).fit(
+                self.flat_arr, self.flat_mask
+            )
+            percentages = counts / counts.sum()
+        elif histogram_bits is None:
+            centers, labels = clustering.fit(self.flat_arr)
+            percentages = np.bincount(labels, minlength=self.NB_CLUSTERS) / self.flat_arr.shape[0]
+        else:
+            colors, counts = color_histogram(self.flat_arr, histogram_bits, self.flat_mask)
+            logging.info(f"{len(colors)} occupied color bins for {counts.sum()} pixels")
+            centers, labels = clustering.fit(colors, counts)
+            percentages = np.bincount(labels, weights=counts, minlength=self.NB_CLUSTERS) / counts.sum()
+
+        if coverage_lut_bits is not None:
+            lut = nearest_center_lut(centers, coverage_lut_bits)
+            full_labels = assign_colors(
+                np.reshape(self.np_arr, (-1, 3)),
+                centers,
+                lut,
+                coverage_lut_bits,
+                mask=np.reshape(self.mask, -1) if self.mask is not None else None,
+            )
+            counts = np.bincount(full_labels, minlength=self.NB_CLUSTERS)[:self.NB_CLUSTERS]
+            percentages = counts / counts.sum()
+            logging.info(f"Coverage measured on {counts.sum()} pixels")
+            if errors is not None:
+                errors = np.zeros(len(percentages))
+
+        dominant_colors = np.array(centers, dtype="uint")
+        order = sorted(
+            range(len(dominant_colors)),
+            key=lambda i: (percentages[i], tuple(dominant_colors[i])),
+            reverse=True,
+        )
 
         self.p_and_c = [
             {
-                'percent': percent,
-                'rgb': rgb,
-            } for percent, rgb in sorted(zip(percentages, dominant_colors), reverse=True)
+                'percent': percentages[i],
+                'rgb': dominant_colors[i],
+            } for i in order
         ]
+        if errors is not None:
+            for i, color in zip(order, self.p_and_c):
+                color['error'] = errors[i]
+
+        self.label_raster = None
+        if coverage_lut_bits is not None and label_raster:
+            ranks = np.full(MASKED_LABEL + 1, MASKED_LABEL, dtype="uint8")
+            ranks[order] = np.arange(len(order))
+            self.label_raster = ranks[full_labels].reshape(self.np_arr.shape[:2])
 
         logging.info("Cluster analysis achieved successfully")
 
         return self.p_and_c
 
-    def make_block_graph(self) -> str:
+    def make_block_graph(self) -> Resource:
         """
         Make plot containing the RGB colors of the 3 dominant colors along with their percentage
         """
@@ -116,12 +548,12 @@ class SatelliteImage():
             )
             plt.yticks([])
 
-        plt.savefig(file_name_box)
-        plt.clf()
+        block_graph = save_figure(file_name_box, self._in_memory)
+        plt.close()
 
-        return file_name_box
+        return block_graph
 
-    def make_bar_chart(self) -> str:
+    def make_bar_chart(self) -> Resource:
         curr_date = datetime.now().strftime("%m-%d-%Y_%H%M%S")
         file_name_bar = f"{self._resources_folder}/dominant_colors_bar_{curr_date}_{self.id}.svg"
 
@@ -139,16 +571,16 @@ class SatelliteImage():
         plt.xticks([])
         plt.yticks([])
 
-        plt.savefig(file_name_bar)
-        plt.clf()
+        bar_chart = save_figure(file_name_bar, self._in_memory)
+        plt.close()
 
-        return file_name_bar
+        return bar_chart
 
-    def make_final_output(self) -> str:
+    def make_final_output(self) -> Resource:
         curr_date = datetime.now().strftime("%m-%d-%Y_%H%M%S")
         file_name_final = f"{self._resources_folder}/image_with_blocks_{curr_date}_{self.id}.png"
 
-        tmp_arr = self.np_arr.copy()
+        tmp_arr = self.report_arr()
         rows = tmp_arr.shape[1]
         cols = tmp_arr.shape[0]
 
@@ -186,6 +618,4 @@ class SatelliteImage():
             )
             start = end + 20
 
-        Image.fromarray(tmp_arr, 'RGB').save(file_name_final)
-
-        return file_name_final
+        return save_image(Image.fromarray(tmp_arr, 'RGB'), file_name_final, self._in_memory)
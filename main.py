@@ -1,29 +1,98 @@
+import argparse
 import configparser
+import csv
 import logging
 import os
 import sys
 import webbrowser
 
+from collections import deque
+from contextlib import nullcontext
 from datetime import datetime
 
 import matplotlib.pyplot as plt
 
-from collect_data import CollectedData
+from batch import collect_many, parse_coordinates, read_coordinates
+from cache import SceneCache, WeatherCache
+from clustering import WarmStart, make_clustering_backend
+from collect_data import CollectedData, WeatherClient
 from final_report import FinalReport
+from parallel_analysis import AnalysisJob, ColorAnalysisPool
+from transport import make_transport
+from weather_store import WeatherStore
 
 
 config = configparser.ConfigParser()
 config.read("config.ini")
-logging.basicConfig(
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler(config['DEFAULT']['logfile']),
-        logging.StreamHandler()
-    ]
-)
-plt.set_loglevel(config['DEFAULT'].get('plt_loglevel', "WARNING"))
-os.makedirs(config['DEFAULT']['resources_folder'], exist_ok=True)
-os.makedirs(config['DEFAULT']['final_reports_folder'], exist_ok=True)
+# shared by every request, created by setup() in the main process only:
+# the spawned analysis workers import this module (as __mp_main__) without running any of it
+in_memory = save_arrays = None
+scene_cache = weather_cache = weather_store = None
+clustering = transport = weather_client = None
+
+
+def setup() -> None:
+    """
+    Sets up logging, the output folders, the caches and the clients as set in the config file
+    """
+    global in_memory, save_arrays, scene_cache, weather_cache, weather_store
+    global clustering, transport, weather_client
+    logging.basicConfig(
+        level=logging.INFO,
+        handlers=[
+            logging.FileHandler(config['DEFAULT']['logfile']),
+            logging.StreamHandler()
+        ]
+    )
+    plt.set_loglevel(config['DEFAULT'].get('plt_loglevel', "WARNING"))
+    in_memory = config['DEFAULT'].getboolean('in_memory', False)
+    save_arrays = config['DEFAULT'].getboolean('save_arrays', not in_memory)
+    # in memory mode, nothing is written to the resources folder unless arrays are explicitly saved
+    # (tiled downloads always write their memory-mapped mosaics there)
+    if not in_memory or save_arrays or config['DEFAULT'].getfloat('scale', 0):
+        os.makedirs(config['DEFAULT']['resources_folder'], exist_ok=True)
+    os.makedirs(config['DEFAULT']['final_reports_folder'], exist_ok=True)
+    scene_cache = (
+        SceneCache(
+            config['DEFAULT']['scene_cache_folder'],
+            config['DEFAULT'].getfloat('scene_cache_size_mb'),
+        )
+        if config['DEFAULT'].getfloat('scene_cache_size_mb', 0) > 0
+        else None
+    )
+    weather_cache = (
+        WeatherCache(
+            config['DEFAULT'].getfloat('weather_cache_cell_size', 0.1),
+            config['DEFAULT'].getfloat('weather_cache_ttl'),
+            config['DEFAULT'].get('weather_cache_folder') or None,
+        )
+        if config['DEFAULT'].getfloat('weather_cache_ttl', 0) > 0
+        else None
+    )
+    weather_store = (
+        WeatherStore(
+            config['DEFAULT']['weather_store_folder'],
+            config['DEFAULT'].getfloat('weather_store_max_age', 0),
+        )
+        if config['DEFAULT'].get('weather_store_folder')
+        else None
+    )
+    clustering = make_clustering_backend(
+        config['DEFAULT'].get('clustering_backend', "sklearn"),
+        warm_start=config['DEFAULT'].getboolean('clustering_warm_start', False),
+    )
+    transport = make_transport(
+        config['DEFAULT'].get('transport', "live"),
+        config['DEFAULT'].get('fixtures_folder', "fixtures"),
+        config['DEFAULT'].getfloat('replay_latency', 0.0),
+    )
+    weather_client = WeatherClient(
+        config['DEFAULT']['api_key'],
+        transport,
+        max_concurrency=config['DEFAULT'].getint('weather_max_concurrency', 8),
+        timeout=config['DEFAULT'].getfloat('weather_timeout', 10),
+        retries=config['DEFAULT'].getint('weather_retries', 3),
+    )
 
 
 def get_float_from_user(msg: str, key: str) -> float:
@@ -56,39 +125,112 @@ def get_float_from_user(msg: str, key: str) -> float:
     return val
 
 
-if __name__ == "__main__":
-    with open(config['DEFAULT']['welcome_banner'], encoding='utf8') as f:
-        contents = f.read()
-        print(
-            contents
-            .replace("\*/", u'\U0001f6a8\U0001f6a8') # replace methods to print emojis
-            .replace("\**/", u'\U0001f692\U0001f9ef\U0001f525')
-        )
+def collection_settings() -> dict:
+    """
+    Keyword arguments of CollectedData, as set in the config file
+    """
+    return {
+        'weather_api_key': config['DEFAULT']['api_key'],
+        'resources_folder': config['DEFAULT']['resources_folder'],
+        'scene_cache': scene_cache,
+        'save_arrs': save_arrays,
+        'in_memory': in_memory,
+        'transport': transport,
+        'download_format': config['DEFAULT'].get('download_format', "float"),
+        'verify_download_format': config['DEFAULT'].getboolean('verify_download_format', False),
+        'aoi_size': config['DEFAULT'].getfloat('aoi_size', 0.2),
+        'scale': config['DEFAULT'].getfloat('scale', 0) or None,
+        'tile_size': config['DEFAULT'].getint('tile_size', 1000),
+        'tile_workers': config['DEFAULT'].getint('tile_workers', 4),
+        'weather_cache': weather_cache,
+        'weather_client': weather_client,
+        'weather_store': weather_store,
+        'dryness_engine': config['DEFAULT'].get('dryness_engine', "color"),
+        'cloud_mask': config['DEFAULT'].getboolean('cloud_mask', False),
+        'max_cloud_cover': config['DEFAULT'].getfloat('max_cloud_cover', 55),
+    }
 
-    lat = get_float_from_user(">>> LAT: ", "lat")
-    lon = get_float_from_user(">>> LON: ", "lon")
-    logging.info(
-        f"User started request with lat={lat} and lon={lon}, {datetime.now().strftime('%Y%m%d-%H:%M:%S')}"
-    )
 
-    # to keep track of the time used to generate the report
-    start = datetime.now()
+def analysis_settings() -> dict:
+    """
+    Keyword arguments of SatelliteImage.run_color_analysis, as set in the config file
+    """
+    return {
+        'clustering': clustering,
+        # the histogram mode clusters the colors of the full resolution images
+        'histogram_bits': (
+            config['DEFAULT'].getint('histogram_bits', 6)
+            if config['DEFAULT'].get('color_analysis', "pixels") == "histogram"
+            else None
+        ),
+        # full coverage measures the percentages on every pixel of the full resolution images
+        'coverage_lut_bits': (
+            config['DEFAULT'].getint('coverage_lut_bits', 5)
+            if config['DEFAULT'].get('coverage', "sample") == "full"
+            else None
+        ),
+        'label_raster': config['DEFAULT'].getboolean('label_raster', False),
+        # the streaming mode clusters every pixel of the full resolution images, chunk by chunk
+        'stream_chunk_size': (
+            config['DEFAULT'].getint('stream_chunk_size', 262144)
+            if config['DEFAULT'].get('color_analysis', "pixels") == "streaming"
+            else None
+        ),
+        'stream_passes': config['DEFAULT'].getint('stream_passes', 10),
+        # the adaptive mode clusters random pixels until the percentages are precise enough
+        'sampling_error': (
+            config['DEFAULT'].getfloat('sampling_error', 0.01)
+            if config['DEFAULT'].get('color_analysis', "pixels") == "adaptive"
+            else None
+        ),
+        'sampling_confidence': config['DEFAULT'].getfloat('sampling_confidence', 0.95),
+        'max_samples': config['DEFAULT'].getint('max_samples', 40000),
+        'sampling_tolerance': config['DEFAULT'].getfloat('sampling_tolerance', 16),
+    }
 
-    data = CollectedData(
-        lat=lat,
-        lon=lon,
-        weather_api_key=config['DEFAULT']['api_key'],
-        resources_folder=config['DEFAULT']['resources_folder'],
-    )
 
-    data.imgs[0].run_color_analysis()
-    data.imgs[1].run_color_analysis()
+def make_analysis_pool() -> ColorAnalysisPool:
+    """
+    Pool of processes analyzing the satellite images in parallel, None to analyze them in the main process
+    """
+    max_workers = config['DEFAULT'].getint('analysis_workers', 0)
+    if max_workers < 1:
+        return None
+    if isinstance(clustering, WarmStart):
+        logging.warning(
+            "clustering_warm_start has no effect with analysis_workers, the images are analyzed independently"
+        )
+    pool = ColorAnalysisPool(max_workers)
+    pool.warm_up()
+    return pool
 
-    data.compute_risk()
 
+def analyze(data: CollectedData, pool: ColorAnalysisPool = None, job: AnalysisJob = None) -> float:
+    """
+    Runs the color analysis of both satellite images and computes the overall risk
+    With a pool, both images are analyzed at the same time (job is an analysis already submitted)
+    """
+    if job is None and pool is not None:
+        job = pool.submit(data.imgs, **analysis_settings())
+    if job is not None:
+        job.result()
+    else:
+        # the second image of a site starts from the centers of the first one, never from another site
+        if isinstance(clustering, WarmStart):
+            clustering.reset()
+        data.imgs[0].run_color_analysis(**analysis_settings())
+        data.imgs[1].run_color_analysis(**analysis_settings())
+
+    return data.compute_risk()
+
+
+def make_report(data: CollectedData, file_name: str = None) -> FinalReport:
+    """
+    Draws the charts of an analyzed site and saves its HTML report
+    """
     fp_resources = {
-        'sat_img_1': data.imgs[0].rgb_img_filename,
-        'sat_img_2': data.imgs[1].rgb_img_filename,
+        'sat_img_1': data.imgs[0].rgb_img_resource,
+        'sat_img_2': data.imgs[1].rgb_img_resource,
         'sat_col_1': data.imgs[0].make_block_graph(),
         'sat_col_2': data.imgs[1].make_block_graph(),
         'temp_chart': data.weather_data.make_temperature_chart(),
@@ -96,6 +238,8 @@ if __name__ == "__main__":
         'wind_chart': data.weather_data.make_wind_chart(),
         'sunlight_chart': data.weather_data.make_sunlight_chart(),
     }
+    if data.change_map is not None:
+        fp_resources['change_map'] = data.make_change_overlay()
     logging.info(fp_resources)
 
     final_report = FinalReport(
@@ -108,16 +252,142 @@ if __name__ == "__main__":
         },
         data.overall_risk,
         config['DEFAULT']['final_reports_folder'],
+        file_name,
     )
     final_report.add_resources(fp_resources)
     final_report.generate()
     final_report.save()
 
+    logging.info("Report was saved at " + final_report.file_name)
+
+    return final_report
+
+
+def run_batch(coordinates: list[tuple[float, float]], with_reports: bool) -> str:
+    """
+    Collects, analyzes and (optionally) reports many sites
+    Collection runs in a pool of threads, color analysis in a pool of processes if one is configured
+    (the images of a site are submitted as soon as it is collected), the rest of the analysis and
+    the charts are kept in the main thread because matplotlib's pyplot interface is not thread-safe
+    At most 2 sites per analysis worker wait in the pool, the collection pauses until the oldest one
+    is analyzed, so that the collected images (and their shared memory blocks) do not pile up
+    Returns the path of the CSV file summarizing the risk of every site
+    """
+    curr_date = datetime.now().strftime("%Y%m%d-%H%M%S")
+    summary_filename = f"{config['DEFAULT']['final_reports_folder']}/batch_summary_{curr_date}.csv"
+    max_workers = config['DEFAULT'].getint('batch_workers', 4)
+
+    logging.info(f"Batch started for {len(coordinates)} sites with {max_workers} workers")
+    start = datetime.now()
+
+    def report_site(lat: float, lon: float, data: CollectedData, job: AnalysisJob = None) -> None:
+        try:
+            risk = analyze(data, job=job)
+            report_name = ""
+            if with_reports:
+                report_name = make_report(
+                    data,
+                    f"{config['DEFAULT']['final_reports_folder']}/firewatcher_report_"
+                    f"{curr_date}_{lat}_{lon}.html",
+                ).file_name
+        except Exception as e:
+            logging.error(f"Analysis failed for lat={lat} and lon={lon}: {e!r}")
+            writer.writerow([lat, lon, "", "", repr(e)])
+            return
+        writer.writerow([lat, lon, risk, report_name, ""])
+
+    pending = deque()
+    with make_analysis_pool() or nullcontext() as pool, open(summary_filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["lat", "lon", "risk", "report", "error"])
+
+        for lat, lon, data in collect_many(
+            coordinates,
+            max_workers,
+            **collection_settings(),
+        ):
+            if isinstance(data, Exception):
+                writer.writerow([lat, lon, "", "", repr(data)])
+                continue
+            if pool is None:
+                report_site(lat, lon, data)
+                continue
+            try:
+                pending.append((lat, lon, data, pool.submit(data.imgs, **analysis_settings())))
+            except Exception as e:
+                logging.error(f"Analysis failed for lat={lat} and lon={lon}: {e!r}")
+                writer.writerow([lat, lon, "", "", repr(e)])
+            while pending and (pending[0][3].done() or len(pending) >= 2 * pool.max_workers):
+                report_site(*pending.popleft())
+
+        while pending:
+            report_site(*pending.popleft())
+
+    time_diff = round((datetime.now() - start).total_seconds(), 2)
+    logging.info(f"Batch of {len(coordinates)} sites was processed in {time_diff} seconds")
+    logging.info("Batch summary was saved at " + summary_filename)
+
+    return summary_filename
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FireWatcher - wildfire risk assessment")
+    parser.add_argument(
+        "--batch",
+        metavar="CSV_FILE",
+        help="CSV file with one lat,lon pair per row, every site is processed in batch mode",
+    )
+    parser.add_argument(
+        "--sites",
+        nargs="+",
+        metavar="LAT,LON",
+        help="coordinates to process in batch mode, e.g. --sites 38.2,-94.2 37.5,-120.1",
+    )
+    parser.add_argument(
+        "--no-reports",
+        action="store_true",
+        help="in batch mode, only compute the risk of every site without generating HTML reports",
+    )
+    args = parser.parse_args()
+    setup()
+
+    if args.batch or args.sites:
+        coordinates = read_coordinates(args.batch) if args.batch else []
+        coordinates += parse_coordinates(args.sites or [])
+        run_batch(coordinates, with_reports=not args.no_reports)
+        sys.exit()
+
+    with open(config['DEFAULT']['welcome_banner'], encoding='utf8') as f:
+        contents = f.read()
+        print(
+            contents
+            .replace("\*/", u'\U0001f6a8\U0001f6a8') # replace methods to print emojis
+            .replace("\**/", u'\U0001f692\U0001f9ef\U0001f525')
+        )
+
+    lat = get_float_from_user(">>> LAT: ", "lat")
+    lon = get_float_from_user(">>> LON: ", "lon")
+    logging.info(
+        f"User started request with lat={lat} and lon={lon}, {datetime.now().strftime('%Y%m%d-%H:%M:%S')}"
+    )
+
+    # to keep track of the time used to generate the report
+    start = datetime.now()
+
+    # the analysis workers start while the data is collected
+    with make_analysis_pool() or nullcontext() as pool:
+        data = CollectedData(
+            lat=lat,
+            lon=lon,
+            **collection_settings(),
+        )
+
+        analyze(data, pool)
+    final_report = make_report(data)
+
     end = datetime.now()
     time_diff = round((end - start).total_seconds(), 2)
     logging.info(f"Report was generated in {time_diff} seconds")
 
-    logging.info("Report was saved at " + final_report.file_name)
-
     print("Opening the report in your browser...")
     webbrowser.open(final_report.file_name, new=2) # new=2 to open in a new tab
@@ -0,0 +1,160 @@
+import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+import numpy as np
+
+from clustering import WarmStart
+from image_analysis import SatelliteImage
+
+
+# attributes of a SatelliteImage needed to run its color analysis, besides np_arr and mask
+_IMAGE_STATE = ('NB_CLUSTERS', 'np_arr_filename', 'arr_format', 'date', 'id', '_resources_folder', '_in_memory')
+
+
+class SharedArray(NamedTuple):
+    """
+    Description of an array placed in shared memory, sent to the workers instead of the array itself
+    """
+    name: str
+    shape: tuple
+    dtype: str
+
+
+def _ready() -> None:
+    pass
+
+
+def _run_color_analysis(
+    shared: SharedArray, state: dict, settings: dict, shared_mask: SharedArray = None
+) -> dict:
+    """
+    Worker side: runs the color analysis of an image whose array (and mask) live in shared memory
+    """
+    # spawned workers share the resource tracker of the parent, which owns (and unlinks) the blocks
+    blocks = [
+        shared_memory.SharedMemory(name=array.name) for array in (shared, shared_mask) if array is not None
+    ]
+    img = SatelliteImage.__new__(SatelliteImage)
+    try:
+        img.__dict__.update(state)
+        img.np_arr = np.ndarray(shared.shape, dtype=shared.dtype, buffer=blocks[0].buf)
+        img.mask = (
+            np.ndarray(shared_mask.shape, dtype=shared_mask.dtype, buffer=blocks[1].buf)
+            if shared_mask is not None else None
+        )
+        img.run_color_analysis(**settings)
+        return {'p_and_c': img.p_and_c, 'label_raster': img.label_raster}
+    finally:
+        img.__dict__.clear() # releases the views on the shared buffers before closing them
+        for shm in blocks:
+            try:
+                shm.close()
+            except BufferError: # a view is still referenced by a traceback, the process keeps the mapping
+                pass
+
+
+class AnalysisJob():
+    """
+    Color analyses of a group of images (e.g. both scenes of a report) running in a ColorAnalysisPool
+    """
+    def __init__(self, imgs: list[SatelliteImage], blocks: list, futures: list[Future]) -> None:
+        self.imgs = imgs
+        self._blocks = blocks
+        self._futures = futures
+
+    def __repr__(self) -> str:
+        return f"AnalysisJob(imgs={len(self.imgs)}, done={self.done()})"
+
+    def done(self) -> bool:
+        return all(future.done() for future in self._futures)
+
+    def result(self) -> list[SatelliteImage]:
+        """
+        Waits for the analyses, then stores their results in the images (p_and_c, label_raster)
+        """
+        try:
+            for img, future in zip(self.imgs, self._futures):
+                result = future.result()
+                img.p_and_c = result['p_and_c']
+                img.label_raster = result['label_raster']
+        finally:
+            self.release()
+        return self.imgs
+
+    def release(self) -> None:
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+
+
+class ColorAnalysisPool():
+    """
+    Runs SatelliteImage.run_color_analysis in worker processes, so that the images of a report
+    (and the reports of a batch) are analyzed on several cores at the same time
+    Image arrays (and masks) are copied once into shared memory, the workers map them without any pickling
+    Workers are spawned (not forked, the parent runs threads) and import the main module once,
+    which must keep its setup under if __name__ == "__main__"
+    """
+    def __init__(self, max_workers: int) -> None:
+        self.max_workers = max_workers
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def __repr__(self) -> str:
+        return f"ColorAnalysisPool(max_workers={self.max_workers})"
+
+    def __enter__(self) -> "ColorAnalysisPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def warm_up(self) -> None:
+        """
+        Starts the workers in the background, e.g. while the data is being collected
+        """
+        for _ in range(self.max_workers):
+            self._executor.submit(_ready)
+
+    @staticmethod
+    def _share(arr: np.ndarray, blocks: list) -> SharedArray:
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        blocks.append(shm)
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        return SharedArray(shm.name, arr.shape, arr.dtype.str)
+
+    def submit(self, imgs: list[SatelliteImage], **settings) -> AnalysisJob:
+        """
+        Starts the color analysis of the images, settings are the arguments of run_color_analysis
+        A WarmStart backend is replaced by its inner backend: each worker gets its own copy of it,
+        the centers found for one image never reach the other one
+        """
+        if isinstance(settings.get('clustering'), WarmStart):
+            settings = {**settings, 'clustering': settings['clustering'].backend}
+        blocks, futures = [], []
+        try:
+            for img in imgs:
+                futures.append(
+                    self._executor.submit(
+                        _run_color_analysis,
+                        self._share(img.np_arr, blocks),
+                        {key: img.__dict__[key] for key in _IMAGE_STATE},
+                        settings,
+                        self._share(img.mask, blocks) if img.mask is not None else None,
+                    )
+                )
+        except Exception:
+            AnalysisJob(imgs, blocks, futures).release()
+            raise
+
+        logging.info(f"Color analysis of {len(imgs)} image(s) submitted to {self}")
+        return AnalysisJob(imgs, blocks, futures)
+
+    def close(self) -> None:
+        self._executor.shutdown()
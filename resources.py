@@ -0,0 +1,44 @@
+import io
+import os
+from typing import Union
+
+import matplotlib.pyplot as plt
+from PIL import Image
+
+
+# a resource is either the path of a file in the resources folder or an in-memory buffer
+Resource = Union[str, io.BytesIO]
+
+
+def save_figure(filename: str, in_memory: bool = False) -> Resource:
+    """
+    Saves the current matplotlib figure to disk, or to a buffer when running in memory
+    The format is always deduced from the extension of filename
+    """
+    if not in_memory:
+        plt.savefig(filename)
+        return filename
+
+    buffer = io.BytesIO()
+    plt.savefig(buffer, format=os.path.splitext(filename)[1][1:])
+    return buffer
+
+
+def save_image(img: Image.Image, filename: str, in_memory: bool = False) -> Resource:
+    """
+    Same as save_figure for PIL images
+    """
+    if not in_memory:
+        img.save(filename)
+        return filename
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=Image.registered_extensions()[os.path.splitext(filename)[1]])
+    return buffer
+
+
+def read_resource(resource: Resource) -> bytes:
+    if isinstance(resource, io.BytesIO):
+        return resource.getvalue()
+    with open(resource, 'rb') as f:
+        return f.read()
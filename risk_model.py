@@ -0,0 +1,114 @@
+from typing import Sequence
+
+import numpy as np
+
+
+# weather aggregates a RiskModel needs, all averaged over the forecast days
+WEATHER_AGGREGATES = ('temperature', 'humidity', 'wind', 'rain', 'sunlight')
+
+
+class RiskModel():
+    """
+    Fire risk formula, independent from the way the data is collected
+    Every input is an array with one entry per site, so that a whole inventory of sites is
+    scored in one call (and can be re-scored in milliseconds when the thresholds change)
+    """
+    def __init__(
+        self,
+        beaufort_scale: Sequence[float] = (0.5, 1.5, 3.3, 5.5, 7.9, 10.7, 13.8, 17.1, 20.7, 24.4, 28.4, 32.6),
+        rainfall_classification: Sequence[float] = (10, 35.5, 64.4, 124.4),
+        temp_classification: Sequence[float] = (4.1, 8.0, 13.0, 18.0, 23.0, 29.0, 35.0, 41.0),
+        max_uv_index: float = 11,
+    ) -> None:
+        self.beaufort_scale = np.asarray(beaufort_scale, dtype="float64")
+        self.rainfall_classification = np.asarray(rainfall_classification, dtype="float64")
+        self.temp_classification = np.asarray(temp_classification, dtype="float64")
+        self.max_uv_index = max_uv_index
+
+    def __repr__(self) -> str:
+        return (
+            f"RiskModel(beaufort_scale={self.beaufort_scale.tolist()}, "
+            f"rainfall_classification={self.rainfall_classification.tolist()}, "
+            f"temp_classification={self.temp_classification.tolist()}, "
+            f"max_uv_index={self.max_uv_index})"
+        )
+
+    @staticmethod
+    def _class_index(avg_metric: np.ndarray, scale: np.ndarray) -> np.ndarray:
+        """
+        Index of the first threshold of scale strictly above avg_metric (len(scale) if there is none)
+        """
+        return np.searchsorted(scale, avg_metric, side='right')
+
+    @staticmethod
+    def aggregate(forecasts: np.ndarray) -> dict[str, np.ndarray]:
+        """
+        Averages FORECAST_DTYPE arrays over their last axis (the forecast days)
+        A (n_sites, n_days) array gives one value per site for each aggregate
+        """
+        return {field: forecasts[field].mean(axis=-1) for field in WEATHER_AGGREGATES}
+
+    def dryness(self, rgb1: np.ndarray, rgb2: np.ndarray) -> np.ndarray:
+        """
+        Dryness of each pair of dominant colors (most recent image first, as in CollectedData.imgs)
+        (n_sites, n_clusters, 3) arrays give a (n_sites, n_clusters) array
+        """
+        rgb1 = np.asarray(rgb1, dtype="float64")  # uint colors would wrap around on subtraction
+        rgb2 = np.asarray(rgb2, dtype="float64")
+        r1, g1 = rgb1[..., 0], rgb1[..., 1]
+        r2, g2 = rgb2[..., 0], rgb2[..., 1]
+        return (1 + (r1 - r2) / r2) * (1 + (g2 - g1) / g1)
+
+    def spectral_dryness(self, d_ndvi: np.ndarray, d_nbr: np.ndarray) -> np.ndarray:
+        """
+        Dryness from the mean drops of the NDVI and NBR between both images (see spectral.SpectralChange)
+        (n_sites,) arrays give a (n_sites, 2) array, one factor per index (1 when nothing changed)
+        """
+        drops = np.stack([np.asarray(d_ndvi, dtype="float64"), np.asarray(d_nbr, dtype="float64")], axis=-1)
+        return np.clip(1 + drops, 0, None)
+
+    def weather_indicators(self, weather: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+        """
+        Weather indicators from the aggregates returned by aggregate
+        """
+        return {
+            'wind': (
+                (self._class_index(weather['wind'], self.beaufort_scale) + 1) / len(self.beaufort_scale)
+            ),
+            'humidity': 1 - np.asarray(weather['humidity']) / 100,
+            'rain': (
+                1 - self._class_index(weather['rain'], self.rainfall_classification)
+                / len(self.rainfall_classification)
+            ),
+            'temp': (
+                (self._class_index(weather['temperature'], self.temp_classification) + 1)
+                / len(self.temp_classification)
+            ),
+            'sunlight': np.asarray(weather['sunlight']) / self.max_uv_index,
+        }
+
+    def score(
+        self,
+        rgb1: np.ndarray,
+        rgb2: np.ndarray,
+        weather: dict[str, np.ndarray],
+        dryness: np.ndarray = None,
+    ) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+        """
+        Risk of N sites from their dominant colors ((N, n_clusters, 3) arrays, most recent image first)
+        and their weather aggregates ((N,) arrays keyed by WEATHER_AGGREGATES)
+        A dryness computed otherwise (e.g. by spectral_dryness) replaces the one of the colors
+        Returns the (N,) risk array and the indicator breakdown
+        """
+        indicators = {'dryness': self.dryness(rgb1, rgb2) if dryness is None else np.asarray(dryness)}
+        indicators.update(self.weather_indicators(weather))
+
+        risk = (
+            np.prod(indicators['dryness'], axis=-1)
+            * indicators['wind']
+            * indicators['humidity']
+            * indicators['rain']
+            * indicators['temp']
+            * indicators['sunlight']
+        )
+        return risk, indicators
@@ -0,0 +1,120 @@
+import numpy as np
+
+
+# red, near infrared and shortwave infrared 2 bands of Landsat 8/9, downloaded as raw digital numbers
+SPECTRAL_BANDS = ("SR_B4", "SR_B5", "SR_B7")
+# Collection 2 surface reflectance scale factors (same as CollectedData.applyScaleFactors)
+DN_SCALE = 0.0000275
+DN_OFFSET = -0.2
+# digital number of the pixels without data
+FILL_DN = 0
+# drop of the indices from which a pixel is counted as dried out (USGS low burn severity threshold of the dNBR)
+DRIED_THRESHOLD = 0.1
+
+
+def _reflectance(dn: np.ndarray, out: np.ndarray) -> np.ndarray:
+    np.multiply(dn, np.float32(DN_SCALE), out=out, dtype="float32")
+    out += np.float32(DN_OFFSET)
+    return out
+
+
+def _normalized_difference(a: np.ndarray, b: np.ndarray, out: np.ndarray, tmp: np.ndarray) -> np.ndarray:
+    """
+    (a - b) / (a + b) written into out, NaN where a + b is 0, clipped to [-1, 1]
+    (negative reflectances of dark pixels can push the ratio out of range)
+    """
+    np.add(a, b, out=tmp)
+    np.subtract(a, b, out=out)
+    np.divide(out, tmp, out=out, where=tmp != 0)
+    out[tmp == 0] = np.nan
+    return np.clip(out, -1, 1, out=out)
+
+
+def spectral_indices(
+    raw_arr: np.ndarray, chunk_rows: int = 128, mask: np.ndarray = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    NDVI and NBR of a scene downloaded with SPECTRAL_BANDS in the dn format, as float32 (h, w) arrays
+    Bands are converted to reflectance chunk_rows rows at a time in preallocated float32 buffers,
+    so no full-size temporary is ever allocated besides both results
+    Fill pixels are NaN, as well as the pixels left out by the mask (True where a pixel is clear,
+    see cloud_mask.clear_mask, on the grid of the bands)
+    """
+    red_band, nir_band, swir_band = SPECTRAL_BANDS
+    height, width = raw_arr.shape
+    ndvi = np.empty((height, width), dtype="float32")
+    nbr = np.empty((height, width), dtype="float32")
+
+    red, nir, swir, tmp = (np.empty((chunk_rows, width), dtype="float32") for _ in range(4))
+    for start in range(0, height, chunk_rows):
+        chunk = raw_arr[start:start+chunk_rows]
+        rows = len(chunk)
+        _reflectance(chunk[red_band], red[:rows])
+        _reflectance(chunk[nir_band], nir[:rows])
+        _reflectance(chunk[swir_band], swir[:rows])
+        _normalized_difference(nir[:rows], red[:rows], ndvi[start:start+rows], tmp[:rows])
+        _normalized_difference(nir[:rows], swir[:rows], nbr[start:start+rows], tmp[:rows])
+
+        fill = (
+            (chunk[red_band] == FILL_DN) | (chunk[nir_band] == FILL_DN) | (chunk[swir_band] == FILL_DN)
+        )
+        if mask is not None:
+            fill |= ~mask[start:start+rows]
+        ndvi[start:start+rows][fill] = np.nan
+        nbr[start:start+rows][fill] = np.nan
+
+    return ndvi, nbr
+
+
+class SpectralChange():
+    """
+    Per-pixel change of the vegetation (NDVI) and burn (NBR) indices between the two scenes of a site
+    d_ndvi and d_nbr are the drops of the indices from the oldest scene to the most recent one,
+    dryness is their average: 0 where nothing changed, positive where the vegetation dried out or burnt,
+    NaN where a scene has no data or is masked
+    Both scenes (and their masks) must be downloaded on the same grid
+    """
+    def __init__(
+        self,
+        recent_arr: np.ndarray,
+        oldest_arr: np.ndarray,
+        chunk_rows: int = 128,
+        recent_mask: np.ndarray = None,
+        oldest_mask: np.ndarray = None,
+    ) -> None:
+        if recent_arr.shape != oldest_arr.shape:
+            raise ValueError(
+                f"Scenes are not on the same grid ({recent_arr.shape} and {oldest_arr.shape})"
+            )
+        for mask in (recent_mask, oldest_mask):
+            if mask is not None and mask.shape != recent_arr.shape:
+                raise ValueError(f"Mask of shape {mask.shape} for scenes of shape {recent_arr.shape}")
+        ndvi_recent, nbr_recent = spectral_indices(recent_arr, chunk_rows, recent_mask)
+        ndvi_oldest, nbr_oldest = spectral_indices(oldest_arr, chunk_rows, oldest_mask)
+        self.stats = {
+            'ndvi_recent': float(np.nanmean(ndvi_recent)),
+            'ndvi_oldest': float(np.nanmean(ndvi_oldest)),
+            'nbr_recent': float(np.nanmean(nbr_recent)),
+            'nbr_oldest': float(np.nanmean(nbr_oldest)),
+        }
+
+        # the arrays of the oldest scene are reused for the differences, and the ones of the recent scene for dryness
+        self.d_ndvi = np.subtract(ndvi_oldest, ndvi_recent, out=ndvi_oldest)
+        self.d_nbr = np.subtract(nbr_oldest, nbr_recent, out=nbr_oldest)
+        self.dryness = np.add(self.d_ndvi, self.d_nbr, out=ndvi_recent)
+        self.dryness *= np.float32(0.5)
+        del nbr_recent
+
+        valid = ~np.isnan(self.dryness)
+        valid_dryness = self.dryness[valid]
+        self.stats.update({
+            'valid': float(valid.mean()),
+            'd_ndvi': float(np.nanmean(self.d_ndvi)),
+            'd_nbr': float(np.nanmean(self.d_nbr)),
+            'dryness_mean': float(valid_dryness.mean()) if valid_dryness.size else np.nan,
+            'dryness_p90': float(np.percentile(valid_dryness, 90)) if valid_dryness.size else np.nan,
+            'dried': float((valid_dryness > DRIED_THRESHOLD).mean()) if valid_dryness.size else np.nan,
+        })
+
+    def __repr__(self) -> str:
+        return f"SpectralChange(shape={self.dryness.shape}, stats={self.stats})"
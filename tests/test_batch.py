@@ -0,0 +1,28 @@
+import threading
+
+import batch
+
+
+def test_collect_many_bounds_the_sites_in_flight(monkeypatch):
+    lock = threading.Lock()
+    state = {'started': 0, 'consumed': 0, 'max_in_flight': 0}
+
+    def fake_collected_data(lat, lon, **kwargs):
+        with lock:
+            state['started'] += 1
+            state['max_in_flight'] = max(state['max_in_flight'], state['started'] - state['consumed'])
+        if lat == 3:
+            raise ValueError("no scene")
+        return (lat, lon)
+
+    monkeypatch.setattr(batch, "CollectedData", fake_collected_data)
+
+    results = []
+    for lat, lon, data in batch.collect_many(((i, -i) for i in range(20)), max_workers=2):
+        results.append((lat, lon, data))
+        with lock:
+            state['consumed'] += 1
+
+    assert sorted(lat for lat, _, _ in results) == list(range(20))
+    assert state['max_in_flight'] <= 4
+    assert isinstance(dict((lat, data) for lat, _, data in results)[3], ValueError)
@@ -0,0 +1,18 @@
+import numpy as np
+
+from clustering import NumpyBackend, WarmStart
+
+
+def test_warm_start_reset_forgets_the_previous_site():
+    rng = np.random.default_rng(0)
+    site_1 = rng.integers(0, 256, (2000, 3)).astype("float64")
+    site_2 = rng.integers(0, 256, (2000, 3)).astype("float64")
+
+    backend = WarmStart(NumpyBackend())
+    backend.fit(site_1)
+    backend.reset()
+    centers, labels = backend.fit(site_2)
+
+    expected_centers, expected_labels = NumpyBackend().fit(site_2)
+    assert np.array_equal(centers, expected_centers)
+    assert np.array_equal(labels, expected_labels)
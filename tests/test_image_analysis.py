@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from clustering import NumpyBackend
+from image_analysis import (
+    MASKED_LABEL,
+    adaptive_sample_fit,
+    assign_colors,
+    color_histogram,
+    nearest_center_lut,
+    nearest_centers,
+)
+
+
+@pytest.mark.parametrize("bits", [4, 5, 6, 8])
+def test_assign_colors_matches_nearest_centers(bits):
+    rng = np.random.default_rng(bits)
+    pixels = rng.integers(0, 256, (50000, 3)).astype("uint8")
+    for _ in range(5):
+        centers = rng.uniform(0, 255, (3, 3))
+        lut = nearest_center_lut(centers, bits)
+        labels = assign_colors(pixels, centers, lut, bits, chunk_size=1 << 12)
+        assert np.array_equal(labels, nearest_centers(pixels, centers))
+
+
+def test_masked_pixels_are_skipped_without_being_copied_out():
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (50000, 3)).astype("uint8")
+    mask = rng.random(len(pixels)) > 0.3
+    centers = rng.uniform(0, 255, (3, 3))
+
+    labels = assign_colors(pixels, centers, nearest_center_lut(centers, 5), 5, chunk_size=1 << 12, mask=mask)
+    assert np.array_equal(labels[mask], nearest_centers(pixels[mask], centers))
+    assert (labels[~mask] == MASKED_LABEL).all()
+
+    for bits in (6, 8):
+        colors, counts = color_histogram(pixels, bits, mask)
+        expected_colors, expected_counts = color_histogram(pixels[mask], bits)
+        assert np.array_equal(counts, expected_counts)
+        assert np.allclose(colors, expected_colors)
+
+
+def test_adaptive_sampling_stops_early_on_a_homogeneous_scene():
+    rng = np.random.default_rng(0)
+    field = np.clip(rng.normal((120, 100, 60), 4, (200000, 3)), 0, 255).astype("uint8")
+    mixed = np.concatenate([field[:140000], np.full((60000, 3), (60, 110, 50), dtype="uint8")])
+
+    _, _, errors = adaptive_sample_fit(field, NumpyBackend(), error=0.01, min_samples=1000)
+    assert errors.max() == pytest.approx(0, abs=1e-6)
+
+    _, percentages, errors = adaptive_sample_fit(mixed, NumpyBackend(), error=0.01, min_samples=1000)
+    assert errors.max() <= 0.01
+    assert percentages.sum() == pytest.approx(1)
@@ -0,0 +1,177 @@
+import io
+import json
+
+import numpy as np
+import pytest
+import requests
+
+from cloud_mask import CLOUD_BIT, QA_BAND
+from clustering import NumpyBackend
+from collect_data import CollectedData, WeatherClient, WeatherData
+from spectral import SPECTRAL_BANDS
+from transport import FixtureStore, ReplayTransport
+
+
+LAT, LON = 38.2, -94.2
+SCENE_IDS = ["LC09_026033_20240601", "LC09_026033_20240516"]
+WEATHER_URL = "https://api.openweathermap.org/data/2.5/onecall"
+
+
+def scene_npy(seed: int) -> bytes:
+    """
+    Scene shaped like a GEE download in the float format: patches of a few colors, with noise
+    """
+    rng = np.random.default_rng(seed)
+    palette = rng.uniform(0.02, 0.28, (3, 3))
+    patches = palette[rng.integers(0, 3, (10, 10))].repeat(10, axis=0).repeat(10, axis=1)
+    reflectance = patches + rng.normal(0, 0.005, patches.shape)
+    scene = np.empty((100, 100), dtype=[(band, "<f8") for band in CollectedData.BANDS])
+    for channel, band in enumerate(CollectedData.BANDS):
+        scene[band] = reflectance[..., channel]
+    buffer = io.BytesIO()
+    np.save(buffer, scene)
+    return buffer.getvalue()
+
+
+def bands_npy(seed: int, bands: tuple) -> bytes:
+    """
+    Raw digital numbers of extra bands, as downloaded in the dn format: the QA band flags a cloud
+    over the top left corner of the first scene, the other bands are random surface reflectances
+    """
+    rng = np.random.default_rng(seed)
+    arr = np.empty((100, 100), dtype=[(band, "<u2") for band in bands])
+    for band in bands:
+        if band == QA_BAND:
+            arr[band] = 0
+            if seed == 0:
+                arr[band][:30, :30] = 1 << CLOUD_BIT
+        else:
+            arr[band] = rng.integers(8000, 20000, (100, 100))
+    buffer = io.BytesIO()
+    np.save(buffer, arr)
+    return buffer.getvalue()
+
+
+def weather_json() -> bytes:
+    return json.dumps({
+        'daily': [
+            {
+                'dt': 1717200000 + 86400 * day,
+                'temp': {'day': 22 + day},
+                'humidity': 40,
+                'wind_speed': 4.5,
+                'rain': 1.5,
+                'pop': 0.2,
+                'uvi': 6,
+            }
+            for day in range(8)
+        ]
+    }).encode()
+
+
+def record_fixtures(folder: str, scene_status: int = 200, weather_status: int = 200) -> FixtureStore:
+    fixtures = FixtureStore(folder)
+    probe = CollectedData.__new__(CollectedData)
+    probe.lat, probe.lon, probe.aoi_size = LAT, LON, 0.2
+    aoi_coords = probe.make_aoi()
+
+    fixtures.save_json(
+        json.dumps(["scenes", CollectedData.COLLECTION_ID, aoi_coords, 2, 55]),
+        {'ids': SCENE_IDS, 'timestamps': [1717200000000, 1715817600000]},
+    )
+    for seed, scene_id in enumerate(SCENE_IDS):
+        url = f"https://earthengine.test/{scene_id}:getPixels"
+        fixtures.save_json(
+            json.dumps(
+                ["download_url", scene_id, aoi_coords, CollectedData.DIMENSIONS, "float", CollectedData.BANDS]
+            ),
+            url,
+        )
+        fixtures.save_response(url, scene_status, "application/octet-stream", scene_npy(seed))
+        # only the QA band and the spectral bands on their own, never both in one download
+        for bands in ((QA_BAND,), SPECTRAL_BANDS):
+            bands_url = f"{url}?bands={','.join(bands)}"
+            fixtures.save_json(
+                json.dumps(["download_url", scene_id, aoi_coords, CollectedData.DIMENSIONS, "dn", bands]),
+                bands_url,
+            )
+            fixtures.save_response(bands_url, 200, "application/octet-stream", bands_npy(seed, bands))
+
+    weather_url = requests.Request("GET", WEATHER_URL, params={
+        'lat': LAT,
+        'lon': LON,
+        'exclude': "current,minutely,hourly",
+        'appid': "KEY",
+        'units': "metric",
+    }).prepare().url
+    fixtures.save_response(weather_url, weather_status, "application/json", weather_json())
+    return fixtures
+
+
+def collect(fixtures: FixtureStore, resources_folder: str, **kwargs) -> CollectedData:
+    transport = ReplayTransport(fixtures)
+    return CollectedData(
+        LAT,
+        LON,
+        "KEY",
+        str(resources_folder),
+        save_arrs=False,
+        in_memory=True,
+        transport=transport,
+        weather_client=WeatherClient("KEY", transport, retries=0),
+        **kwargs,
+    )
+
+
+def test_replayed_collection_and_risk(tmp_path):
+    data = collect(record_fixtures(tmp_path / "fixtures"), tmp_path)
+
+    assert data.scene_ids == tuple(SCENE_IDS)
+    # 1 scene query + 1 download URL per image
+    assert data.gee_round_trips == 3
+    assert [img.np_arr.shape for img in data.imgs] == [(100, 100, 3), (100, 100, 3)]
+    assert len(data.weather_data.forecast) == 8
+
+    for img in data.imgs:
+        img.run_color_analysis(NumpyBackend())
+        assert np.isclose(sum(color['percent'] for color in img.p_and_c), 1)
+    risk = data.compute_risk()
+
+    assert np.isfinite(risk) and risk > 0
+    assert len(data.indicators['dryness']) == 3
+    # same inputs, same risk
+    again = collect(record_fixtures(tmp_path / "fixtures"), tmp_path)
+    for img in again.imgs:
+        img.run_color_analysis(NumpyBackend())
+    assert again.compute_risk() == risk
+
+
+def test_spectral_engine_reuses_the_cloud_masks(tmp_path):
+    data = collect(
+        record_fixtures(tmp_path / "fixtures"), tmp_path, cloud_mask=True, dryness_engine="spectral"
+    )
+
+    assert data.masks[0][:30, :30].sum() == 0 and data.masks[1].all()
+    assert np.isnan(data.spectral_change.dryness[:30, :30]).all()
+    assert data.spectral_change.stats['valid'] == pytest.approx(1 - 0.09)
+
+
+def test_failed_scene_download_raises(tmp_path):
+    with pytest.raises(ValueError, match="Could not download scene"):
+        collect(record_fixtures(tmp_path / "fixtures", scene_status=500), tmp_path)
+
+
+def test_weather_error_status_raises(tmp_path):
+    with pytest.raises(requests.HTTPError):
+        collect(record_fixtures(tmp_path / "fixtures", weather_status=401), tmp_path)
+
+
+def test_standalone_weather_data_closes_its_client(tmp_path, monkeypatch):
+    closed = []
+    monkeypatch.setattr(WeatherClient, "close", lambda client: closed.append(client))
+    transport = ReplayTransport(record_fixtures(tmp_path / "fixtures"))
+
+    weather_data = WeatherData(LAT, LON, "KEY", str(tmp_path), in_memory=True, transport=transport)
+
+    assert len(weather_data.forecast) == 8
+    assert len(closed) == 1
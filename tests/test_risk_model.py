@@ -0,0 +1,78 @@
+import math
+
+import numpy as np
+
+from collect_data import FORECAST_DTYPE
+from risk_model import RiskModel
+
+
+def baseline_risk(colors_recent: list, colors_oldest: list, forecast: np.ndarray) -> float:
+    """
+    Risk as computed by the original CollectedData.compute_risk, one site at a time
+    """
+    def get_index(avg_metric, scale):
+        for i, threshold in enumerate(scale):
+            if avg_metric < threshold:
+                return i
+        return len(scale)
+
+    dryness = [
+        (1 + (rgb1[0] - rgb2[0]) / rgb2[0]) * (1 + (rgb2[1] - rgb1[1]) / rgb1[1])
+        for rgb1, rgb2 in zip(colors_recent, colors_oldest)
+    ]
+    beaufort_scale = [0.5, 1.5, 3.3, 5.5, 7.9, 10.7, 13.8, 17.1, 20.7, 24.4, 28.4, 32.6]
+    rainfall_classification = [10, 35.5, 64.4, 124.4]
+    temp_classification = [4.1, 8.0, 13.0, 18.0, 23.0, 29.0, 35.0, 41.0]
+    wind = (get_index(forecast['wind'].mean(), beaufort_scale) + 1) / len(beaufort_scale)
+    humidity = 1 - forecast['humidity'].mean() / 100
+    rain = 1 - get_index(forecast['rain'].mean(), rainfall_classification) / len(rainfall_classification)
+    temp = (get_index(forecast['temperature'].mean(), temp_classification) + 1) / len(temp_classification)
+    sunlight = forecast['sunlight'].mean() / 11
+    return math.prod(dryness) * wind * humidity * rain * temp * sunlight
+
+
+def make_forecast(temperature: float, humidity: float, wind: float, rain: float, sunlight: float) -> np.ndarray:
+    forecast = np.zeros(8, dtype=FORECAST_DTYPE)
+    forecast['dt'] = 1700000000 + 86400 * np.arange(8)
+    forecast['temperature'] = temperature + np.arange(8)
+    forecast['humidity'] = humidity
+    forecast['wind'] = wind
+    forecast['rain'] = rain
+    forecast['sunlight'] = sunlight
+    return forecast
+
+
+def test_score_reproduces_baseline_compute_risk():
+    # the most recent image got redder and less green: drier than the oldest one
+    colors_recent = [[140, 110, 70], [60, 90, 50], [200, 190, 170]]
+    colors_oldest = [[120, 125, 75], [50, 100, 45], [195, 192, 168]]
+    forecast = make_forecast(24, 35, 6.2, 2.5, 7)
+
+    model = RiskModel()
+    risk, indicators = model.score(
+        [colors_recent], [colors_oldest], model.aggregate(forecast[np.newaxis])
+    )
+
+    assert np.isclose(risk[0], baseline_risk(colors_recent, colors_oldest, forecast))
+    assert (indicators['dryness'][0] > 1).all()
+
+
+def test_score_is_vectorized_over_sites():
+    rng = np.random.default_rng(0)
+    colors_recent = rng.integers(20, 230, (5, 3, 3))
+    colors_oldest = rng.integers(20, 230, (5, 3, 3))
+    forecasts = np.stack([
+        make_forecast(temperature, humidity, wind, rain, sunlight)
+        for temperature, humidity, wind, rain, sunlight in zip(
+            [5, 15, 25, 35, 45], [80, 60, 40, 20, 10], [1, 4, 9, 15, 30], [0, 5, 40, 80, 150], [2, 4, 6, 8, 10]
+        )
+    ])
+
+    model = RiskModel()
+    risk, _ = model.score(colors_recent, colors_oldest, model.aggregate(forecasts))
+
+    expected = [
+        baseline_risk(recent.tolist(), oldest.tolist(), forecast)
+        for recent, oldest, forecast in zip(colors_recent, colors_oldest, forecasts)
+    ]
+    assert np.allclose(risk, expected)
@@ -0,0 +1,65 @@
+import math
+from typing import NamedTuple
+
+
+METERS_PER_DEGREE = 111320
+
+
+class Tile(NamedTuple):
+    row: int  # position of the tile in the mosaic, in pixels
+    col: int
+    rows: int  # size of the tile, in pixels
+    cols: int
+    crs_transform: list  # affine transform of the tile in EPSG:4326
+
+
+class AoiTiler():
+    """
+    Splits a rectangular region into tiles small enough for a single GEE download request
+    Every tile shares the same EPSG:4326 pixel grid (constant pixel size in degrees),
+    so that the tiles abut exactly once written side by side in the mosaic
+    """
+    def __init__(
+        self,
+        west: float,
+        south: float,
+        east: float,
+        north: float,
+        scale: float,
+        max_tile_px: int = 1000,
+    ) -> None:
+        self.west = west
+        self.north = north
+        self.max_tile_px = max_tile_px
+        # pixel size in degrees, the longitude one is corrected at the center of the region
+        self.px_lat = scale / METERS_PER_DEGREE
+        self.px_lon = scale / (METERS_PER_DEGREE * math.cos(math.radians((north + south) / 2)))
+        self.width = math.ceil((east - west) / self.px_lon)
+        self.height = math.ceil((north - south) / self.px_lat)
+
+    def __repr__(self) -> str:
+        return (
+            f"AoiTiler(shape={self.shape}, tiles={len(self.tiles())}, max_tile_px={self.max_tile_px})"
+        )
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.height, self.width
+
+    def tiles(self) -> list[Tile]:
+        tiles = []
+        for row in range(0, self.height, self.max_tile_px):
+            for col in range(0, self.width, self.max_tile_px):
+                tiles.append(
+                    Tile(
+                        row,
+                        col,
+                        min(self.max_tile_px, self.height - row),
+                        min(self.max_tile_px, self.width - col),
+                        [
+                            self.px_lon, 0, self.west + col * self.px_lon,
+                            0, -self.px_lat, self.north - row * self.px_lat,
+                        ],
+                    )
+                )
+        return tiles
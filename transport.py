@@ -0,0 +1,212 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import ee
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+# query parameters that must never end up in a fixture key (credentials)
+_SECRET_PARAMS = {"appid"}
+
+
+def _normalize_url(url: str) -> str:
+    """
+    Removes credentials and sorts the query string so that a request always has the same key
+    """
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query) if k not in _SECRET_PARAMS)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+
+class FixtureStore():
+    """
+    Folder of recorded responses, each file is named after a hash of the request it answers
+    GEE responses are stored as JSON, HTTP responses as their raw body plus a JSON metadata file
+    """
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        os.makedirs(self.folder, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"FixtureStore(folder={self.folder})"
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.folder, hashlib.sha256(key.encode()).hexdigest() + ext)
+
+    def _write(self, path: str, content: bytes) -> None:
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def save_json(self, key: str, value: Any) -> None:
+        self._write(self._path(key, ".json"), json.dumps({'key': key, 'value': value}).encode())
+
+    def load_json(self, key: str) -> Any:
+        try:
+            with open(self._path(key, ".json"), encoding="utf8") as f:
+                return json.load(f)['value']
+        except FileNotFoundError:
+            raise LookupError(f"No recorded GEE response for {key}") from None
+
+    def save_response(self, url: str, status_code: int, content_type: str, content: bytes) -> None:
+        key = _normalize_url(url)
+        self._write(self._path(key, ".bin"), content)
+        self._write(
+            self._path(key, ".meta.json"),
+            json.dumps({'url': key, 'status_code': status_code, 'content_type': content_type}).encode(),
+        )
+
+    def load_response(self, url: str) -> tuple[int, str, bytes]:
+        key = _normalize_url(url)
+        try:
+            with open(self._path(key, ".meta.json"), encoding="utf8") as f:
+                meta = json.load(f)
+            with open(self._path(key, ".bin"), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            raise LookupError(f"No recorded HTTP response for {key}") from None
+        return meta['status_code'], meta['content_type'], content
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Regular HTTP adapter that also saves every response it receives to a fixture store
+    """
+    def __init__(self, fixtures: FixtureStore, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.fixtures = fixtures
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        response = super().send(request, **kwargs)
+        # reading the body here keeps it available to the caller, streamed or not
+        self.fixtures.save_response(
+            request.url,
+            response.status_code,
+            response.headers.get('content-type', ""),
+            response.content,
+        )
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    HTTP adapter serving recorded responses, no network access is needed
+    """
+    def __init__(self, fixtures: FixtureStore, latency: float = 0.0) -> None:
+        super().__init__()
+        self.fixtures = fixtures
+        self.latency = latency
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        time.sleep(self.latency)
+        status_code, content_type, content = self.fixtures.load_response(request.url)
+
+        response = requests.Response()
+        response.status_code = status_code
+        response.reason = "Replayed"
+        response.headers = CaseInsensitiveDict({
+            'content-type': content_type,
+            'content-length': str(len(content)),
+        })
+        response.raw = io.BytesIO(content)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+class LiveTransport():
+    """
+    Gives access to Google Earth Engine and to HTTP endpoints
+    CollectedData and WeatherData make all their requests through a transport, which makes it
+    possible to record them (RecordingTransport) and to serve them back offline (ReplayTransport)
+    """
+    _gee_lock = threading.Lock()
+    _gee_initialized = False
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}()"
+
+    def initialize_gee(self) -> None:
+        # ee.Authenticate()
+        with LiveTransport._gee_lock:
+            if LiveTransport._gee_initialized:
+                return
+            logging.info("Initializing Google Earth Engine...")
+            ee.Initialize()
+            logging.info("Google Earth Engine initialized successfully!")
+            LiveTransport._gee_initialized = True
+
+    def gee_request(self, key: str, request: Callable[[], Any]) -> Any:
+        """
+        Runs a blocking GEE request (getInfo, getDownloadURL...)
+        key describes the request with plain values, request builds the ee objects and sends it
+        """
+        return request()
+
+    def make_adapter(self, **kwargs) -> BaseAdapter:
+        return HTTPAdapter(**kwargs)
+
+
+class RecordingTransport(LiveTransport):
+    def __init__(self, fixtures: FixtureStore) -> None:
+        self.fixtures = fixtures
+
+    def __repr__(self) -> str:
+        return f"RecordingTransport(fixtures={self.fixtures})"
+
+    def gee_request(self, key: str, request: Callable[[], Any]) -> Any:
+        response = request()
+        self.fixtures.save_json(key, response)
+        return response
+
+    def make_adapter(self, **kwargs) -> BaseAdapter:
+        return RecordingAdapter(self.fixtures, **kwargs)
+
+
+class ReplayTransport():
+    """
+    Serves recorded responses back, with an optional latency injected in every request
+    GEE is never initialized and no ee object is ever built
+    """
+    def __init__(self, fixtures: FixtureStore, latency: float = 0.0) -> None:
+        self.fixtures = fixtures
+        self.latency = latency
+
+    def __repr__(self) -> str:
+        return f"ReplayTransport(fixtures={self.fixtures}, latency={self.latency})"
+
+    def initialize_gee(self) -> None:
+        logging.info(f"Replaying recorded responses from {self.fixtures.folder}")
+
+    def gee_request(self, key: str, request: Callable[[], Any]) -> Any:
+        time.sleep(self.latency)
+        return self.fixtures.load_json(key)
+
+    def make_adapter(self, **kwargs) -> BaseAdapter:
+        return ReplayAdapter(self.fixtures, self.latency)
+
+
+def make_transport(mode: str, fixtures_folder: str, latency: float = 0.0):
+    """
+    mode is one of "live", "record" or "replay"
+    """
+    if mode == "live":
+        return LiveTransport()
+    if mode == "record":
+        return RecordingTransport(FixtureStore(fixtures_folder))
+    if mode == "replay":
+        return ReplayTransport(FixtureStore(fixtures_folder), latency)
+    raise ValueError(f"Unknown transport mode: {mode} (expected live, record or replay)")
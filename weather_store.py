@@ -0,0 +1,139 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+class WeatherStore():
+    """
+    Append-only history of every weather forecast fetched, to follow how forecasts evolve over time
+    Each fetch is written once and never modified, as a compressed .npz file holding one array per
+    column, under folder/site=<lat>_<lon>/date=<YYYY-MM-DD>/ (UTC date of the fetch)
+    The most recent fetch of a site is served back as long as it is less than max_age seconds old
+    """
+    def __init__(self, folder: str, max_age: float = 0) -> None:
+        self.folder = folder
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return (
+            f"WeatherStore(folder={self.folder}, max_age={self.max_age}, "
+            f"hits={self.hits}, misses={self.misses})"
+        )
+
+    def _site_path(self, lat: float, lon: float) -> str:
+        return os.path.join(self.folder, f"site={lat:.4f}_{lon:.4f}")
+
+    @staticmethod
+    def _day(timestamp: float) -> str:
+        return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+    def _partitions(self, lat: float, lon: float, start: float = None, end: float = None) -> list[str]:
+        """
+        Date partitions of a site overlapping [start, end), oldest first
+        """
+        site_path = self._site_path(lat, lon)
+        try:
+            days = sorted(
+                entry.name[len("date="):] for entry in os.scandir(site_path)
+                if entry.name.startswith("date=")
+            )
+        except FileNotFoundError:
+            return []
+        if start is not None:
+            days = [day for day in days if day >= self._day(start)]
+        if end is not None:
+            days = [day for day in days if day <= self._day(end)]
+        return [os.path.join(site_path, f"date={day}") for day in days]
+
+    @staticmethod
+    def _fetches(partition: str) -> list[tuple[int, str]]:
+        """
+        (fetched_at in ms, path) of the fetches of a partition, oldest first
+        """
+        return sorted(
+            (int(entry.name.split("_")[0]), entry.path) for entry in os.scandir(partition)
+            if entry.name.endswith(".npz")
+        )
+
+    @staticmethod
+    def _read(path: str) -> np.ndarray:
+        with np.load(path) as npz:
+            columns = npz['_columns'].tolist()
+            rows = np.empty(len(npz[columns[0]]), dtype=[(name, npz[name].dtype) for name in columns])
+            for name in columns:
+                rows[name] = npz[name]
+        return rows
+
+    def append(self, lat: float, lon: float, rows: np.ndarray, fetched_at: float = None) -> str:
+        """
+        Writes the rows of a structured array fetched at the given time (now by default)
+        Returns the path of the new file
+        """
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        partition = os.path.join(self._site_path(lat, lon), f"date={self._day(fetched_at)}")
+        os.makedirs(partition, exist_ok=True)
+
+        path = os.path.join(partition, f"{round(fetched_at * 1000)}_{uuid.uuid4().hex[:8]}.npz")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                _columns=np.array(rows.dtype.names),
+                **{name: rows[name] for name in rows.dtype.names},
+            )
+        os.replace(tmp_path, path) # atomic, readers never see a partial fetch
+        return path
+
+    def latest(self, lat: float, lon: float) -> np.ndarray:
+        """
+        Rows of the most recent fetch of a site, None if there is none younger than max_age
+        """
+        now = time.time()
+        partitions = self._partitions(lat, lon, start=now - self.max_age)
+        fetches = self._fetches(partitions[-1]) if partitions else []
+        if fetches and now - fetches[-1][0] / 1000 <= self.max_age:
+            with self._lock:
+                self.hits += 1
+            return self._read(fetches[-1][1])
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def query(self, lat: float, lon: float, start: datetime = None, end: datetime = None) -> np.ndarray:
+        """
+        All the rows of a site fetched in [start, end), oldest fetch first
+        The returned structured array starts with a 'fetched_at' column (POSIX timestamp)
+        """
+        start = start.timestamp() if start is not None else None
+        end = end.timestamp() if end is not None else None
+
+        parts = []
+        for partition in self._partitions(lat, lon, start, end):
+            for fetched_at_ms, path in self._fetches(partition):
+                fetched_at = fetched_at_ms / 1000
+                if (start is not None and fetched_at < start) or (end is not None and fetched_at >= end):
+                    continue
+                rows = self._read(path)
+                part = np.empty(len(rows), dtype=[('fetched_at', "float64")] + rows.dtype.descr)
+                part['fetched_at'] = fetched_at
+                for name in rows.dtype.names:
+                    part[name] = rows[name]
+                parts.append(part)
+
+        logging.info(f"Weather store: {len(parts)} fetch(es) for lat={lat} and lon={lon}")
+        if not parts:
+            return None
+        return np.concatenate(parts)
+
+    def log_stats(self) -> None:
+        logging.info(f"Weather store: {self.hits} hit(s), {self.misses} miss(es)")